@@ -0,0 +1,147 @@
+''' Key-to-command latency under a saturating data stream.
+
+A feeder thread writes simulated CTD output into a pipe at a fixed rate.
+The event loop reads the pipe in reads of at most 1024 bytes, as the
+serial transport does, and passes the data to the CTD interface. A
+second thread presses the space bar (which sends an empty command to the
+CTD) at regular intervals. The screen is rendered at the UI's refresh
+rate. The latency is the time from the key press to the command being written. Both the default mode
+(parsing on the event loop) and pipeline mode (parsing in a worker process)
+are measured, using the terminal plot backend so that no plot process is
+needed.
+
+Usage: python benchmarks/key_latency.py [duration in seconds] [lines per second]
+'''
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+from ctdsampler import ctd
+from ctdsampler import graphs
+from ctdsampler import pipeline
+from ctdsampler import ui as ctdsampler_ui
+
+LINE = b" 10.12345,  20.54321,   4.12345,  20.11111,   0.00100,  30.00000\r\n"
+# serial_asyncio reads at most 1024 bytes at a time
+READ_SIZE = 1024
+KEY_INTERVAL = 0.05
+
+
+class AlarmLoop(object):
+    ''' Stands in for the urwid main loop, which runs the UI frame timer
+        and draws the screen after it.
+    '''
+    def __init__(self, loop, top):
+        self.loop = loop
+        self.top = top
+
+    def set_alarm_in(self, seconds, callback):
+        self.loop.call_later(seconds, self.frame, callback)
+
+    def frame(self, callback):
+        callback(self)
+        self.top.render((80, 24))
+
+
+class Transport(object):
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.t_key = None
+
+    def write(self, data):
+        if self.t_key is not None:
+            self.latencies.append(time.perf_counter() - self.t_key)
+            self.t_key = None
+
+
+def press_keys(loop, ui, transport, stop):
+    while True:
+        time.sleep(KEY_INTERVAL)
+        if stop.is_set():
+            break
+        transport.t_key = time.perf_counter()
+        loop.call_soon_threadsafe(ui.key_handler, ' ')
+
+
+def feed(fd, rate, counter, stop):
+    ''' Writes lines to fd at the given rate, in bursts every millisecond.
+        If the reader falls behind, the write blocks once the pipe is full.
+    '''
+    t0 = time.perf_counter()
+    try:
+        while not stop.is_set():
+            n = int((time.perf_counter() - t0)*rate) - counter[0]
+            if n > 0:
+                os.write(fd, LINE*n)
+                counter[0] += n
+            time.sleep(1e-3)
+    except BrokenPipeError:
+        pass
+    os.close(fd)
+
+
+def run(use_pipeline, duration, rate):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    queue = ctd.SampleQueue(1000, 'drop-oldest')
+    ui = ctdsampler_ui.UI(loop, queue)
+    ui.graph = graphs.Graph(100, 'terminal')
+    ui.widgets, ui.scrolled_texts = ui.create_widgets()
+    ui.redraw(AlarmLoop(loop, ui.build_top(ui.widgets)))
+
+    if use_pipeline:
+        ui.worker = pipeline.ParserWorker(loop, queue, ui.apply_batch, ui.sizes['top'],
+                                          ui.sizes['body'], 100)
+        ui.worker.start()
+        interface = ctd.PipelineCTDInterface()
+        interface.queue = ui.worker
+    else:
+        interface = ctd.CTDInterface()
+        interface.queue = queue
+        task = loop.create_task(ui.parse_input())
+    latencies = []
+    transport = Transport(latencies)
+    interface.connection_made(transport)
+    ui.writer = interface.writer
+
+    read_fd, write_fd = os.pipe()
+    loop.add_reader(read_fd, lambda: interface.data_received(os.read(read_fd, READ_SIZE)))
+    counter = [0]
+    stop = threading.Event()
+    threads = [threading.Thread(target=feed, args=(write_fd, rate, counter, stop), daemon=True),
+               threading.Thread(target=press_keys, args=(loop, ui, transport, stop), daemon=True)]
+    for thread in threads:
+        thread.start()
+    loop.run_until_complete(asyncio.sleep(duration))
+    stop.set()
+    loop.remove_reader(read_fd)
+    os.close(read_fd)
+    for thread in threads:
+        thread.join()
+    if ui.worker:
+        ui.worker.stop()
+    else:
+        task.cancel()
+        loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    return np.array(latencies)*1e3, counter[0]/duration, queue.dropped['drop-oldest']
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv)>1 else 5
+    rate = float(sys.argv[2]) if len(sys.argv)>2 else 20000
+    print(f"{'mode':10s} {'lines/s':>10s} {'dropped':>10s} {'median (ms)':>12s} {'95% (ms)':>10s} {'max (ms)':>10s}")
+    for mode, use_pipeline in (('loop', False), ('pipeline', True)):
+        latency, lines_per_second, dropped = run(use_pipeline, duration, rate)
+        print(f"{mode:10s} {lines_per_second:10.0f} {dropped:10d} {np.median(latency):12.2f} "
+              f"{np.percentile(latency, 95):10.2f} {latency.max():10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+import json
+import os
+import struct
+import warnings
+import zlib
+
+import numpy as np
+
+from . import broadcast
+
+# Archive of a ctdsampler session: the samples, compressed in chunks of a
+# fixed number of samples, and metadata (CTD configuration, calibration
+# data). The file is a sequence of blocks:
+#
+#   block header: kind (4 bytes), size of the body (uint32), little endian
+#
+#   b'META' body: JSON object {"key": ..., "value": ...}. Later blocks
+#               with the same key replace earlier ones.
+#   b'CHNK' body: chunk header, number of samples (uint32), time of the
+#               first and last sample (float64), min, max and mean of each
+#               channel (float64), followed by the samples, compressed with
+#               zlib. The samples are stored per channel with their bytes
+#               shuffled (all first bytes, all second bytes, ...), which
+#               compresses much better than row major float64 values.
+#   b'TAIL' body: as CHNK, the samples that do not fill a chunk yet. It
+#               is the last block of the file, rewritten every
+#               flush_interval seconds, so that the samples of a slow
+#               stream are not held in memory only.
+#   b'INDX' body: the index, one record per chunk (see INDEX_DTYPE).
+#
+# The file ends with the offset of the index (uint64) and END_MAGIC. The
+# index makes a range query decompress only the chunks that overlap the
+# range, and an overview be drawn from the chunk summaries without
+# decompressing anything. If the session did not end cleanly, the index
+# is missing, and is rebuilt by scanning the block headers; the TAIL
+# block is then read as a last chunk.
+#
+# Chunks hold chunk_size samples, except the last chunk of a session,
+# which is written on close. A session can be appended to an existing
+# archive: the index and trailer (or the TAIL block and an incomplete
+# block, after an unclean end) are cut off, the samples of the TAIL
+# block are taken up in the next chunk, the new blocks follow the
+# existing ones, and the index written at the end holds all chunks.
+#
+# The channels are those of broadcast.CHANNELS (time c t d dt P T).
+
+MAGIC = b'CTDA'
+END_MAGIC = b'CTDE'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHH')
+BLOCK = struct.Struct('<4sI')
+CHUNK = struct.Struct('<Idd')
+TRAILER = struct.Struct('<Q4s')
+CHANNELS = broadcast.CHANNELS
+N_CHANNELS = len(CHANNELS) - 1
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('n', '<u4'), ('t0', '<f8'), ('t1', '<f8'),
+                        ('min', '<f8', N_CHANNELS), ('max', '<f8', N_CHANNELS),
+                        ('mean', '<f8', N_CHANNELS)])
+
+
+def statistics(values):
+    ''' Returns min, max and mean of each column, ignoring NaNs (NaN for
+        columns without values).
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmin(values, axis=0), np.nanmax(values, axis=0), np.nanmean(values, axis=0)
+
+
+def shuffle(data):
+    ''' Byte-shuffles an array of samples (n_samples x n_channels). '''
+    data = np.ascontiguousarray(np.asarray(data, dtype='<f8').T)
+    return data.view(np.uint8).reshape(data.shape[0], -1, 8).transpose(0, 2, 1).tobytes()
+
+
+def unshuffle(b, n):
+    ''' Inverse of shuffle() for n samples. '''
+    data = np.frombuffer(b, dtype=np.uint8).reshape(-1, 8, n).transpose(0, 2, 1)
+    return np.ascontiguousarray(data).view('<f8')[..., 0].T
+
+
+def to_row(t, sample):
+    ''' Returns the row of the archive (time c t d dt P T) of a sample
+        (c, t, d, dt, P, T) received at time t. dt is None for converted
+        output, and NaN in the archive.
+    '''
+    return (t, *[np.nan if v is None else v for v in sample])
+
+
+class ArchiveWriter(object):
+    ''' Writes a session archive, or appends a session to an existing one.
+        Samples are collected until a chunk is full. Every flush_interval
+        seconds, the samples collected are saved in the TAIL block.
+    '''
+    def __init__(self, filename, loop=None, chunk_size=1024, level=6, flush_interval=10.):
+        ''' Constructor
+
+        Params:
+        -------
+        filename: name of the archive. If it exists, the session is
+                  appended to it, and ValueError is raised if it is not
+                  an archive.
+        loop: asyncio event loop, on which the TAIL block is written every
+              flush_interval seconds. If None, only full chunks are written.
+        chunk_size: number of samples per chunk
+        level: zlib compression level
+        flush_interval: time (s) between writes of the TAIL block
+        '''
+        self.filename = filename
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.level = level
+        self.flush_interval = flush_interval
+        self.samples = []
+        self.index = []
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with Archive(filename) as archive:
+                self.index = [np.array(record, dtype=INDEX_DTYPE) for record in archive.index]
+                if not archive.tail is None:
+                    # the samples of the TAIL block go into the next chunk.
+                    self.samples = archive.read_chunk(len(self.index) - 1).tolist()
+                    self.index.pop()
+                # end of the last META or CHNK block, where blocks are written
+                self.end = archive.end
+            self.fp = open(filename, 'r+b')
+            self.fp.truncate(self.end)
+        else:
+            self.fp = open(filename, 'wb')
+            self.fp.write(FILE_HEADER.pack(MAGIC, VERSION, N_CHANNELS))
+            self.end = self.fp.tell()
+            self.add_metadata('channels', CHANNELS)
+        self.handle = None
+        if loop:
+            self.handle = loop.call_later(flush_interval, self.flush)
+
+    def write_block(self, kind, body):
+        ''' Writes a block at the end, replacing the TAIL block. '''
+        self.fp.seek(self.end)
+        self.fp.write(BLOCK.pack(kind, len(body)) + body)
+        if kind != b'TAIL':
+            self.end = self.fp.tell()
+        self.fp.truncate()
+        self.fp.flush()
+
+    def add_metadata(self, key, value):
+        ''' Adds metadata, a JSON serialisable value. '''
+        body = json.dumps(dict(key=key, value=value)).encode('utf-8')
+        self.write_block(b'META', body)
+        self.write_tail()
+
+    def add_configuration(self, filename):
+        ''' Adds a Seabird_CTD_configuration file (saved with key P). '''
+        self.add_metadata('configuration', configuration_to_metadata(filename))
+
+    def add_calibration(self, name, filename):
+        ''' Adds a calibration data file under name. '''
+        self.add_metadata(f'calibration/{name}', calibration_to_metadata(filename))
+
+    def append(self, t, sample):
+        ''' Adds a CTD sample (c, t, d, dt, P, T) received at time t. dt is
+            None for converted output.
+        '''
+        self.samples.append(to_row(t, sample))
+        if len(self.samples) >= self.chunk_size:
+            self.write_chunk()
+
+    def extend(self, rows):
+        ''' Adds samples as rows (see to_row()), a list or an array. '''
+        self.samples.extend(np.asarray(rows, dtype=float).tolist())
+        while len(self.samples) >= self.chunk_size:
+            self.write_chunk()
+
+    def flush(self):
+        ''' Saves the samples collected, every flush_interval seconds. '''
+        self.write_tail()
+        self.handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def encode_chunk(self, data):
+        ''' Returns the index record and the body of a chunk of samples. '''
+        record = np.zeros((), dtype=INDEX_DTYPE)
+        record['offset'] = self.end
+        record['n'] = data.shape[0]
+        record['t0'], record['t1'] = data[0, 0], data[-1, 0]
+        record['min'], record['max'], record['mean'] = statistics(data[:, 1:])
+        header = CHUNK.pack(data.shape[0], data[0, 0], data[-1, 0])
+        header += np.hstack([record['min'], record['max'], record['mean']]).astype('<f8').tobytes()
+        return record, header + zlib.compress(shuffle(data), self.level)
+
+    def write_chunk(self):
+        ''' Writes a chunk of the samples collected, up to chunk_size. '''
+        if not self.samples:
+            return
+        data = np.array(self.samples[:self.chunk_size], dtype=float)
+        del self.samples[:self.chunk_size]
+        record, body = self.encode_chunk(data)
+        self.write_block(b'CHNK', body)
+        self.index.append(record)
+
+    def write_tail(self):
+        ''' Saves the samples collected in the TAIL block. '''
+        if self.samples:
+            self.write_block(b'TAIL', self.encode_chunk(np.array(self.samples, dtype=float))[1])
+
+    def close(self):
+        if self.handle:
+            self.handle.cancel()
+        while self.samples:
+            self.write_chunk()
+        body = np.array(self.index, dtype=INDEX_DTYPE).tobytes()
+        offset = self.end
+        self.write_block(b'INDX', body)
+        self.fp.write(TRAILER.pack(offset, END_MAGIC))
+        self.fp.close()
+
+
+class Archive(object):
+    ''' Reads a session archive. '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, 'rb')
+        header = self.fp.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or header[:4] != MAGIC:
+            self.fp.close()
+            raise ValueError(f"{filename} is not a ctdsampler archive.")
+        magic, version, n_channels = FILE_HEADER.unpack(header)
+        if version > VERSION or n_channels != N_CHANNELS:
+            raise ValueError(f"Unsupported archive version {version} of {filename}.")
+        self.metadata = {}
+        self.index = self.read_index()
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *p):
+        self.close()
+
+    def blocks(self, offset=FILE_HEADER.size):
+        ''' Iterates over the blocks from offset, yielding offset, kind and
+            the size of the body. A truncated block ends the iteration.
+        '''
+        size = os.fstat(self.fp.fileno()).st_size
+        while offset + BLOCK.size <= size:
+            self.fp.seek(offset)
+            kind, n = BLOCK.unpack(self.fp.read(BLOCK.size))
+            if offset + BLOCK.size + n > size:
+                break
+            yield offset, kind, n
+            offset += BLOCK.size + n
+
+    def read_index(self):
+        size = os.fstat(self.fp.fileno()).st_size
+        index = None
+        if size >= FILE_HEADER.size + TRAILER.size:
+            self.fp.seek(size - TRAILER.size)
+            offset, magic = TRAILER.unpack(self.fp.read(TRAILER.size))
+            if magic == END_MAGIC:
+                self.fp.seek(offset)
+                _, n = BLOCK.unpack(self.fp.read(BLOCK.size))
+                index = np.frombuffer(self.fp.read(n), dtype=INDEX_DTYPE)
+        records = []
+        # end of the last META or CHNK block, where a session is appended,
+        # and the offset of the TAIL block, if any.
+        self.end = FILE_HEADER.size
+        self.tail = None
+        for offset, kind, n in self.blocks():
+            if kind == b'META':
+                item = json.loads(self.fp.read(n))
+                self.metadata[item['key']] = item['value']
+            elif kind in (b'CHNK', b'TAIL') and index is None:
+                # no index, the session did not end cleanly.
+                records.append(self.read_chunk_header(offset))
+            if kind == b'TAIL':
+                self.tail = offset
+            if kind in (b'TAIL', b'INDX'):
+                break
+            self.end = offset + BLOCK.size + n
+        if index is None:
+            index = np.array(records, dtype=INDEX_DTYPE)
+        return index
+
+    def read_chunk_header(self, offset):
+        self.fp.seek(offset + BLOCK.size)
+        n, t0, t1 = CHUNK.unpack(self.fp.read(CHUNK.size))
+        stats = np.frombuffer(self.fp.read(3*N_CHANNELS*8), dtype='<f8').reshape(3, N_CHANNELS)
+        record = np.zeros((), dtype=INDEX_DTYPE)
+        record['offset'], record['n'], record['t0'], record['t1'] = offset, n, t0, t1
+        record['min'], record['max'], record['mean'] = stats
+        return record
+
+    def read_chunk(self, i):
+        ''' Returns the samples of chunk i (n_samples x len(CHANNELS)). '''
+        record = self.index[i]
+        self.fp.seek(int(record['offset']))
+        _, size = BLOCK.unpack(self.fp.read(BLOCK.size))
+        header_size = CHUNK.size + 3*N_CHANNELS*8
+        self.fp.seek(header_size, os.SEEK_CUR)
+        return unshuffle(zlib.decompress(self.fp.read(size - header_size)), int(record['n']))
+
+    def chunks(self, t0=-np.inf, t1=np.inf):
+        ''' Returns the indices of the chunks overlapping the time range.
+            Chunks are in time order.
+        '''
+        i0 = np.searchsorted(self.index['t1'], t0, side='left')
+        i1 = np.searchsorted(self.index['t0'], t1, side='right')
+        return range(i0, max(i0, i1))
+
+    def query(self, channels=None, t0=-np.inf, t1=np.inf):
+        ''' Returns the samples between t0 and t1 (inclusive).
+
+        Parameters:
+        ----------
+        channels: a channel name or list of names (see CHANNELS), default all.
+        t0, t1: time range in seconds since 1970
+
+        Returns:
+        --------
+        times and values (n_samples, or n_samples x number of channels if
+        channels is a list)
+        '''
+        if channels is None:
+            channels = CHANNELS[1:]
+        columns = CHANNELS.index(channels) if isinstance(channels, str) else [CHANNELS.index(k) for k in channels]
+        data = [self.read_chunk(i) for i in self.chunks(t0, t1)]
+        if not data:
+            data = np.empty((0, len(CHANNELS)))
+        else:
+            data = np.vstack(data)
+        data = data[(data[:, 0] >= t0) & (data[:, 0] <= t1)]
+        return data[:, 0], data[:, columns]
+
+    def summary(self, channel):
+        ''' Returns per chunk the time of the first and last sample, and the
+            min, max and mean of channel.
+        '''
+        k = CHANNELS.index(channel) - 1
+        index = self.index
+        return index['t0'], index['t1'], index['min'][:, k], index['max'][:, k], index['mean'][:, k]
+
+    def overview(self, channels=None, f=None, ax=None):
+        ''' Plots the range and mean of the channels per chunk, from the
+            chunk summaries only.
+        '''
+        import matplotlib.pyplot as plt
+        if channels is None:
+            channels = [k for k in CHANNELS[1:] if np.any(np.isfinite(self.summary(k)[2]))]
+        if f is None or ax is None:
+            f, ax = plt.subplots(len(channels), 1, sharex=True, squeeze=False)
+            ax = ax[:, 0]
+        for _ax, k in zip(ax, channels):
+            t0, t1, vmin, vmax, vmean = self.summary(k)
+            t = (t0 + t1)/2
+            _ax.fill_between(t, vmin, vmax, step='mid', alpha=0.3)
+            _ax.plot(t, vmean, drawstyle='steps-mid')
+            _ax.set_ylabel(k)
+        ax[-1].set_xlabel('Time (s)')
+        return f, ax
+
+
+def configuration_to_metadata(filename):
+    ''' Converts a Seabird_CTD_configuration file to metadata: the text as
+        saved, and the coefficients.
+    '''
+    # imported here, as calibration imports pyplot, which the main
+    # process does not need otherwise.
+    from . import calibration
+    with open(filename, 'r') as fp:
+        text = fp.read()
+    return dict(text=text, coefficients=calibration.read_configuration(filename))
+
+
+def metadata_to_configuration(metadata, filename):
+    ''' Writes configuration metadata as a Seabird_CTD_configuration file,
+        which can be read by calibration.read_configuration().
+    '''
+    with open(filename, 'w') as fp:
+        if 'text' in metadata:
+            fp.write(metadata['text'])
+        else:
+            for k, v in metadata['coefficients'].items():
+                fp.write(f"{k} = {v}\n")
+
+
+def calibration_to_metadata(filename):
+    ''' Converts a calibration data file (as read by calibration.Calibration.load_data())
+        to metadata: the comment lines and the rows of values.
+    '''
+    header = []
+    rows = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            if line.startswith("#"):
+                header.append(line.rstrip('\n'))
+            elif line.strip():
+                rows.append([float(i) for i in line.split()])
+    return dict(header=header, rows=rows)
+
+
+def metadata_to_calibration(metadata, filename):
+    ''' Writes calibration metadata as a calibration data file. '''
+    with open(filename, 'w') as fp:
+        for line in metadata['header']:
+            fp.write(f"{line}\n")
+        for row in metadata['rows']:
+            fp.write(" ".join(f"{v}" for v in row) + "\n")
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import socket
+import struct
+import time
+
+import numpy as np
+
+# Fan-out server for the parsed sample stream. Local consumers (loggers,
+# notebooks, other plotting tools) connect to a unix domain socket or a TCP
+# port on localhost and receive batches of samples as binary frames:
+#
+#   header : magic (4 bytes), sequence number (uint32), number of samples
+#            (uint32), number of channels (uint16), little endian
+#   payload: number of samples x number of channels float64 values, row major
+#
+# The channels are given by CHANNELS. dt is NaN if the CTD outputs
+# converted data.
+
+MAGIC = b'CTDS'
+HEADER = struct.Struct('<4sIIH')
+CHANNELS = 'time c t d dt P T'.split()
+
+
+def parse_address(address):
+    ''' Parses a server address.
+
+    Parameters:
+    ----------
+    address: a port number, or localhost:port, for a TCP server, a path
+             for a unix domain socket.
+
+    Returns:
+    --------
+    tuple of ('tcp', port) or ('unix', path)
+    '''
+    if address.isdigit():
+        return 'tcp', int(address)
+    host, _, port = address.rpartition(':')
+    if host in ('localhost', '127.0.0.1') and port.isdigit():
+        return 'tcp', int(port)
+    return 'unix', address
+
+
+def encode_frame(sequence_number, samples):
+    ''' Encodes a list of samples into a binary frame. '''
+    payload = np.asarray(samples, dtype='<f8')
+    n, m = payload.shape
+    return HEADER.pack(MAGIC, sequence_number, n, m) + payload.tobytes()
+
+
+def decode_frame(header, payload):
+    ''' Decodes a frame
+
+    Returns:
+    --------
+    the sequence number and an array of size (number of samples x number of channels)
+    '''
+    magic, sequence_number, n, m = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a ctdsampler frame.")
+    return sequence_number, np.frombuffer(payload, dtype='<f8').reshape(n, m)
+
+
+def payload_size(header):
+    ''' Returns the number of bytes of the payload following header. '''
+    _, _, n, m = HEADER.unpack(header)
+    return n*m*8
+
+
+class Subscriber(object):
+    ''' A connected client. Frames are buffered in a bounded buffer. If the
+        client does not keep up, the oldest frames are dropped, so that a
+        slow client never stalls the acquisition.
+    '''
+    def __init__(self, writer, buffer_size):
+        self.writer = writer
+        self.frames = asyncio.Queue(buffer_size)
+        self.dropped = 0
+
+    def offer(self, frame):
+        if self.frames.full():
+            self.frames.get_nowait()
+            self.dropped+=1
+        self.frames.put_nowait(frame)
+
+    async def run(self):
+        try:
+            while True:
+                frame = await self.frames.get()
+                self.writer.write(frame)
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writer.close()
+
+
+class SampleServer(object):
+    ''' Broadcasts the samples that are published, in batches, to any
+        number of subscribers.
+    '''
+    def __init__(self, loop, address, batch_interval=0.1, buffer_size=64):
+        ''' Constructor
+
+        Params:
+        -------
+        loop: asyncio event loop
+        address: server address (see parse_address())
+        batch_interval: time in seconds samples are collected before they
+                        are sent as one frame.
+        buffer_size: number of frames buffered per subscriber.
+        '''
+        self.loop = loop
+        self.address = address
+        self.batch_interval = batch_interval
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.samples = []
+        self.sequence_number = 0
+        self.server = None
+        self.flush_handle = None
+
+    async def start(self):
+        kind, address = parse_address(self.address)
+        if kind == 'tcp':
+            self.server = await asyncio.start_server(self.connected, '127.0.0.1', address)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = await asyncio.start_unix_server(self.connected, address)
+
+    async def connected(self, reader, writer):
+        subscriber = Subscriber(writer, self.buffer_size)
+        self.subscribers.add(subscriber)
+        try:
+            await subscriber.run()
+        finally:
+            self.subscribers.discard(subscriber)
+
+    @property
+    def dropped(self):
+        ''' Total number of frames dropped for the connected subscribers. '''
+        return sum(s.dropped for s in self.subscribers)
+
+    def publish(self, c, t, d, dt, P, T):
+        ''' Publish a sample. The sample is sent with the next batch. '''
+        if dt is None:
+            dt = np.nan
+        self.samples.append((time.time(), c, t, d, dt, P, T))
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.batch_interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        if not self.samples:
+            return
+        frame = encode_frame(self.sequence_number, self.samples)
+        self.samples = []
+        self.sequence_number = (self.sequence_number + 1) % 2**32
+        for subscriber in self.subscribers:
+            subscriber.offer(frame)
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+        if self.server:
+            self.server.close()
+            kind, address = parse_address(self.address)
+            if kind == 'unix' and os.path.exists(address):
+                os.unlink(address)
+
+
+def subscribe(address):
+    ''' Blocking client, for use in scripts and notebooks.
+
+    Parameters:
+    ----------
+    address: server address (see parse_address())
+
+    Returns:
+    --------
+    a generator yielding the sequence number and the samples of each frame
+    received.
+    '''
+    kind, address = parse_address(address)
+    if kind == 'tcp':
+        sock = socket.create_connection(('127.0.0.1', address))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    with sock, sock.makefile('rb') as fp:
+        while len(header:=fp.read(HEADER.size)) == HEADER.size:
+            payload = fp.read(payload_size(header))
+            yield decode_frame(header, payload)
@@ -1,13 +1,383 @@
+import io
+import itertools
+import multiprocessing as mp
+import re
 import sys
+from functools import partial
 import numpy as np
 from matplotlib import pyplot as plt
-from scipy.optimize import fmin
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 
-# bath_temp bath_cond inst_freq
-# degree C  S/m       Hz
+# Data files (one per sensor):
+#
+# conductivity: bath_temp bath_cond inst_freq
+#               degree C  S/m       Hz
+# temperature : bath_temp inst_counts
+#               degree C  counts
+# pressure    : bath_temp ref_pres inst_counts inst_temp_counts
+#               degree C  psia     counts      counts
 
 Coefs = namedtuple('Coefs', 'g h i j'.split())
+TemperatureCoefs = namedtuple('TemperatureCoefs', 'ta0 ta1 ta2 ta3'.split())
+PressureCoefs = namedtuple('PressureCoefs', 'pa0 pa1 pa2 ptempa0 ptempa1 ptempa2'.split())
+# Result of fitting a variant of the conductivity model, see compare_models()
+ModelFit = namedtuple('ModelFit', 'free coefs CTcor WBOTC rms aic bic iterations'.split())
+
+
+def fit_linear(A, y, w=None):
+    ''' Weighted linear least squares fit, vectorized over any leading
+        dimensions, so that many sensors are fitted in one go.
+
+    Parameters:
+    ----------
+    A: design matrices (..., n_points, n_coefs)
+    y: observations (..., n_points)
+    w: weights (..., n_points), default 1. Points with zero weight are
+       ignored, which allows padding data sets of different lengths.
+
+    Returns:
+    --------
+    coefficients (..., n_coefs)
+    '''
+    A = np.asarray(A, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if w is None:
+        w = np.ones_like(y)
+    sw = np.sqrt(np.asarray(w, dtype=float))
+    Aw = A*sw[..., None]
+    # scale the columns, as the powers of the sensor values differ in
+    # magnitude by orders.
+    scale = np.abs(Aw).max(axis=-2)
+    scale[scale==0] = 1
+    Q, R = np.linalg.qr(Aw/scale[..., None, :])
+    Qty = np.swapaxes(Q, -1, -2) @ (y*sw)[..., None]
+    return np.linalg.solve(R, Qty)[..., 0]/scale
+
+
+LOSSES = ('least_squares', 'huber', 'tukey')
+
+
+def residual_scale(r, active, n_coefs=0):
+    ''' Robust estimate of the scale of the residuals (normalized median
+        absolute deviation) of the points taking part in the fit,
+        corrected for the degrees of freedom, as the residuals of a fit of
+        few points are smaller than the errors.
+
+    Parameters:
+    ----------
+    r: residuals (..., n_points)
+    active: points taking part in the fit (..., n_points)
+    n_coefs: number of coefficients fitted
+
+    Returns:
+    --------
+    scale (..., 1)
+    '''
+    _r = np.where(active, r, np.nan)
+    mad = np.nanmedian(np.abs(_r - np.nanmedian(_r, axis=-1, keepdims=True)), axis=-1, keepdims=True)
+    n = np.count_nonzero(active, axis=-1)[..., None]
+    dof = np.sqrt(n/np.maximum(n - n_coefs, 1))
+    return np.maximum(1.4826*mad*dof, np.finfo(float).tiny)
+
+
+def robust_weights(r, active, loss, scale=None):
+    ''' Weights of iteratively reweighted least squares for robust losses.
+
+    Parameters:
+    ----------
+    r: residuals (..., n_points)
+    active: points taking part in the fit (..., n_points)
+    loss: one of LOSSES
+    scale: scale of the residuals (..., 1), default residual_scale(r, active)
+
+    Returns:
+    --------
+    weights (..., n_points), relative to the weights of least squares.
+    '''
+    if loss == 'least_squares':
+        return np.ones_like(r)
+    if scale is None:
+        scale = residual_scale(r, active)
+    u = np.abs(r)/scale
+    if loss == 'huber':
+        c = 1.345
+        return np.where(u <= c, 1., c/np.maximum(u, c))
+    elif loss == 'tukey':
+        c = 4.685
+        return np.where(u < c, (1 - (u/c)**2)**2, 0.)
+    raise ValueError(f"Unknown loss: {loss}")
+
+
+def reweighted_fit(fit, residuals, active, loss, n_coefs, max_iterations=50, rtol=1e-10,
+                   coefs=lambda x: x):
+    ''' Fits by iteratively reweighted least squares (IRLS).
+
+    The scale of the residuals is estimated once, from the least squares
+    fit, and kept fixed: re-estimating it every iteration lets it shrink
+    onto the points that fit best, until the others are all rejected. The
+    Tukey loss, which rejects points, starts from the Huber solution, with
+    the scale of its residuals. Points are only rejected as long as at
+    least n_coefs points remain.
+
+    Parameters:
+    ----------
+    fit: function of the robust weights (..., n_points), returning the solution
+    residuals: function of a solution, returning the weighted residuals (..., n_points)
+    active: points taking part in the fit (..., n_points)
+    loss: one of LOSSES
+    n_coefs: number of coefficients fitted
+    max_iterations: maximum number of iterations per loss
+    rtol: relative change of the coefficients at which iterating stops
+    coefs: function returning the coefficients of a solution
+
+    Returns:
+    --------
+    solution, robust weights (..., n_points)
+    '''
+    rw = np.ones(np.shape(active))
+    x = fit(rw)
+    if loss == 'least_squares':
+        return x, rw
+    for _loss in (('huber',) if loss == 'huber' else ('huber', loss)):
+        scale = residual_scale(residuals(x), active, n_coefs)
+        for i in range(max_iterations):
+            _rw = robust_weights(residuals(x), active, _loss, scale)
+            too_few = np.count_nonzero(active & (_rw > 0), axis=-1) < n_coefs
+            _rw[too_few] = rw[too_few]
+            _x = fit(_rw)
+            converged = np.allclose(coefs(_x), coefs(x), rtol=rtol, atol=0)
+            x, rw = _x, _rw
+            if converged:
+                break
+    return x, rw
+
+
+def calibrate_all(calibrations, loss='least_squares', max_iterations=50, rtol=1e-10):
+    ''' Calibrates a number of sensors (conductivity, temperature and
+        pressure, of any number of instruments). Fits of the same size
+        are stacked and solved in one vectorized fit per stage.
+
+    Parameters:
+    ----------
+    calibrations: list of Calibration instances with data loaded.
+    loss: least_squares, or huber or tukey, which are fitted by
+          iteratively reweighted least squares (see reweighted_fit()).
+    max_iterations: maximum number of iterations for robust losses
+    rtol: relative change of the coefficients at which iterating stops
+    '''
+    n_stages = max(c.n_stages for c in calibrations)
+    for stage in range(n_stages):
+        groups = defaultdict(list)
+        for c in calibrations:
+            if stage < c.n_stages:
+                A, y, w = c.get_design(stage)
+                w = w*c.point_weights(A.shape[0])
+                if np.count_nonzero(w) < A.shape[1]:
+                    raise ValueError(f"{np.count_nonzero(w)} points included, at least "
+                                     f"{A.shape[1]} are needed to fit {A.shape[1]} coefficients")
+                groups[A.shape[1]].append((c, A, y, w))
+        for n_coefs, problems in groups.items():
+            n = max(A.shape[0] for _, A, _, _ in problems)
+            As = np.zeros((len(problems), n, n_coefs))
+            ys = np.zeros((len(problems), n))
+            ws = np.zeros((len(problems), n))
+            for k, (_, A, y, w) in enumerate(problems):
+                m = A.shape[0]
+                As[k, :m], ys[k, :m], ws[k, :m] = A, y, w
+            coefs, rw = reweighted_fit(lambda rw: fit_linear(As, ys, ws*rw),
+                                       lambda coefs: ((As @ coefs[..., None])[..., 0] - ys)*np.sqrt(ws),
+                                       ws>0, loss, n_coefs, max_iterations, rtol)
+            for k, (c, A, _, _) in enumerate(problems):
+                c.robust_weights = rw[k, :A.shape[0]]
+                c.set_coefs(stage, coefs[k])
+
+
+def levenberg_marquardt(residuals, jacobian, x0, max_iterations=100, tol=1e-12):
+    ''' Nonlinear least squares fit by the Levenberg-Marquardt method.
+
+    The columns of the Jacobian are scaled to unit norm, so that parameters
+    differing in magnitude by orders (as g and CTcor) are damped alike.
+
+    Parameters:
+    ----------
+    residuals: function returning the residuals (n_points) at x
+    jacobian: function returning the Jacobian of the residuals (n_points, n_params) at x
+    x0: initial estimate
+    max_iterations: maximum number of iterations
+    tol: relative change of the cost, or of the parameters, at which iterating stops
+
+    Returns:
+    --------
+    parameters, residuals, number of iterations
+    '''
+    x = np.array(x0, dtype=float)
+    r = residuals(x)
+    cost = r @ r
+    n = x.shape[0]
+    damping = 1e-3
+    for iteration in range(1, max_iterations+1):
+        J = jacobian(x)
+        scale = np.linalg.norm(J, axis=0)
+        scale[scale==0] = 1
+        while True:
+            A = np.vstack([J/scale, np.sqrt(damping)*np.eye(n)])
+            b = np.hstack([-r, np.zeros(n)])
+            step = np.linalg.lstsq(A, b, rcond=None)[0]/scale
+            _r = residuals(x + step)
+            _cost = _r @ _r
+            if _cost <= cost:
+                break
+            damping*=10
+            if damping > 1e12:
+                return x, r, iteration
+        converged = (cost - _cost <= tol*cost or
+                     np.all(np.abs(step) <= tol*np.abs(x)))
+        x, r, cost = x + step, _r, _cost
+        damping = max(damping/10, 1e-12)
+        if converged:
+            break
+    return x, r, iteration
+
+
+def fit_conductivity_model(F, t, p, C, w, WBOTC, CPcor, CTcor, free=()):
+    ''' Fits the conductivity model
+
+        C = (g + h f^2 + i f^3 + j f^4)/(1 + CTcor t + CPcor p), f = F sqrt(1 + WBOTC t)/1000
+
+    for g, h, i, j and the parameters named in free (CTcor and/or WBOTC),
+    with an analytic Jacobian. The fit starts from the linear fit with
+    the given CTcor and WBOTC.
+
+    Parameters:
+    ----------
+    F, t, p, C: instrument frequency (Hz), bath temperature, pressure and
+                bath conductivity
+    w: weights of the points
+    WBOTC, CPcor, CTcor: values of the parameters that are not fitted, and
+                         initial values of those that are.
+    free: names of the parameters to fit besides g, h, i and j
+
+    Returns:
+    --------
+    ModelFit
+    '''
+    names = ('CTcor', 'WBOTC')
+    for k in free:
+        if not k in names:
+            raise ValueError(f"Cannot fit {k}, only {names}")
+    free = tuple(k for k in names if k in free)
+    sw = np.sqrt(w)
+
+    def unpack(x):
+        values = dict(CTcor=CTcor, WBOTC=WBOTC)
+        values.update(zip(free, x[4:]))
+        return x[:4], values['CTcor'], values['WBOTC']
+
+    def model(x):
+        (g, h, i, j), ctcor, wbotc = unpack(x)
+        f = F*np.sqrt(1 + wbotc*t)/1000
+        P = g + h*f**2 + i*f**3 + j*f**4
+        D = 1 + ctcor*t + CPcor*p
+        return f, P, D
+
+    def residuals(x):
+        _, P, D = model(x)
+        return sw*(C - P/D)
+
+    def jacobian(x):
+        (g, h, i, j), ctcor, wbotc = unpack(x)
+        f, P, D = model(x)
+        columns = [np.ones_like(f)/D, f**2/D, f**3/D, f**4/D]
+        for k in free:
+            if k == 'CTcor':
+                columns.append(-P*t/D**2)
+            else:
+                dPdf = 2*h*f + 3*i*f**2 + 4*j*f**3
+                columns.append(dPdf*f*t/(2*(1 + wbotc*t))/D)
+        return -sw[:, None]*np.vstack(columns).T
+
+    f = F*np.sqrt(1 + WBOTC*t)/1000
+    D = 1 + CTcor*t + CPcor*p
+    A = np.vstack([np.ones_like(f), f**2, f**3, f**4]).T
+    x0 = np.hstack([fit_linear(A, C*D, w/D**2), [dict(CTcor=CTcor, WBOTC=WBOTC)[k] for k in free]])
+    if free:
+        x, r, iterations = levenberg_marquardt(residuals, jacobian, x0)
+    else:
+        x, r, iterations = x0, residuals(x0), 0
+    coefs, ctcor, wbotc = unpack(x)
+    # information criteria of a least squares fit with gaussian errors
+    n = np.count_nonzero(w)
+    k = x.shape[0]
+    rss = max(r @ r, np.finfo(float).tiny)
+    aic = n*np.log(rss/n) + 2*k
+    bic = n*np.log(rss/n) + k*np.log(n)
+    return ModelFit(free, Coefs(*coefs), ctcor, wbotc, np.sqrt(rss/n), aic, bic, iterations)
+
+
+def _fit_conductivity_model(args):
+    return fit_conductivity_model(*args)
+
+
+def compare_models(calibrations, variants=((), ('CTcor',), ('WBOTC',), ('CTcor', 'WBOTC')),
+                   processes=None):
+    ''' Fits variants of the conductivity model, which fit CTcor and/or
+        WBOTC besides g, h, i and j, in parallel.
+
+    Parameters:
+    ----------
+    calibrations: list of ConductivityCalibration instances with data loaded
+    variants: names of the parameters fitted in each variant
+    processes: number of worker processes. By default, one per ten
+               instruments, up to the number of cores, as starting a
+               process takes longer than fitting a few instruments. With
+               1, the fits are done in this process.
+
+    Returns:
+    --------
+    per calibration, list of ModelFit, ranked by BIC (lowest first)
+    '''
+    tasks = [c.model_arguments() + (free,) for c, free in itertools.product(calibrations, variants)]
+    if processes is None:
+        processes = min(mp.cpu_count(), len(calibrations)//10 + 1)
+    if processes == 1:
+        fits = list(map(_fit_conductivity_model, tasks))
+    else:
+        with mp.get_context('spawn').Pool(processes) as pool:
+            fits = pool.map(_fit_conductivity_model, tasks)
+    n = len(variants)
+    return [sorted(fits[k*n:(k+1)*n], key=lambda fit: fit.bic) for k in range(len(calibrations))]
+
+
+def report_models(fits, glider, fp=sys.stdout):
+    ''' Writes a table of model variants, as returned by compare_models().
+
+    Differences in AIC or BIC of more than about 2 are significant; a
+    variant fitting more parameters is only justified if it lowers them.
+    '''
+    s = f"Conductivity model variants {glider.capitalize()}:\n"
+    fp.write(s)
+    fp.write("-"*len(s)+'\n')
+    fp.write(f"{'fitted':22s} {'rms (S/m)':>10s} {'AIC':>9s} {'BIC':>9s} {'CTcor':>12s} {'WBOTC':>12s}\n")
+    for fit in fits:
+        fitted = ", ".join(('g h i j',) + fit.free)
+        fp.write(f"{fitted:22s} {fit.rms:10.3e} {fit.aic:9.2f} {fit.bic:9.2f} "
+                 f"{fit.CTcor:12.5e} {fit.WBOTC:12.5e}\n")
+    fp.write("\n")
+
+
+def read_configuration(filename):
+    ''' Reads the calibration coefficients from a configuration file, as
+        saved by ctdsampler (key P, command dc).
+
+    Returns:
+    --------
+    dictionary with the coefficients (TA0, G, CTCOR, PA0, ...)
+    '''
+    with open(filename, 'r') as fp:
+        # the CTD breaks the lines at arbitrary places.
+        s = fp.read().replace('\n', '')
+    number = r'[-+]?\d+\.?\d*(?:[eE][-+]?\d+)?'
+    return dict((k.upper(), float(v)) for k, v in re.findall(rf'(\w+)\s*=\s*({number})', s))
 
 class KeyboardInput(object):
     def __init__(self):
@@ -49,66 +419,103 @@ class KeyboardInput(object):
                      
     
     
-class ConductivityCalibration(object):
+class Calibration(object):
+    ''' Base class of the sensor calibrations.
+
+        Subclasses define the data columns, the coefficients read from a
+        configuration file (configuration_keys, mapping to attribute names)
+        and the linear fits (design() and set_coefs()) of each stage.
+    '''
+    columns = []
+    configuration_keys = {}
+    n_stages = 1
+    title = "Calibration coefficients"
+    reference = None
+    label = None
+    ylabel = None
+    unit = None
+    residual_limit = None
+
     def __init__(self):
-        self.WBOTC = 4.7841e-7
-        self.CPcor = -9.57e-8
-        self.CTcor = 3.25e-5
-        self.bath_temp = []
-        self.bath_cond = []
-        self.inst_freq = []
-        
+        for column in self.columns:
+            setattr(self, column, [])
+        # per point weights and mask (False excludes a point), None for all 1/True.
+        self.weights = None
+        self.mask = None
+        self.loss = 'least_squares'
+        self.designs = {}
+
     def load_data(self, filename):
+        self.designs.clear()
         with open(filename, 'r') as fp:
             while line:=fp.readline():
-                if line.strip().startswith("#"):
+                if line.strip().startswith("#") or not line.strip():
                     continue
                 else:
-                    bath_temp, bath_cond, inst_freq = [float(i) for i in line.split()]
-                    self.bath_temp.append(bath_temp)
-                    self.bath_cond.append(bath_cond)
-                    self.inst_freq.append(inst_freq)
+                    values = [float(i) for i in line.split()]
+                    for column, value in zip(self.columns, values):
+                        getattr(self, column).append(value)
 
-    def conductivity(self, f, t, p, coefs, delta, epsilon):
-        g,h, i, j = coefs
-        C = (g + h*f**2 + i*f**3 + j*f**4)/(1+delta*t + epsilon*p)
-        return C
+    def load_configuration(self, filename):
+        ''' Sets the fixed coefficients from a configuration file (see read_configuration()). '''
+        configuration = read_configuration(filename)
+        for key, attribute in self.configuration_keys.items():
+            if key in configuration:
+                setattr(self, attribute, configuration[key])
 
-    def cost_fun(self, coefs, C, f, t, p, delta, epsilon):
-        g,h, i, j = coefs
-        coefs = self.normalise_coefs(coefs, reverse=True)
-        Csensor = self.conductivity(f, t, p, coefs, delta, epsilon)
-        cost = ((Csensor-C)**2).sum()
-        return cost
-    
-    def normalise_coefs(self, coefs, reverse=False):
-        factors = np.array([1, 1e-1, 1e-4, 1e-5])
-        if reverse:
-            factors = 1/factors
-        coefs = [i/j for i,j in zip(coefs, factors)]
-        return coefs
+    def design(self, stage):
+        ''' Returns the design matrix, observations and weights of the fit of given stage. '''
+        raise NotImplementedError()
 
-    @property
-    def f(self):
-        f = np.array(self.inst_freq) * np.sqrt(1.0 + self.WBOTC)/1000.0
-        return f
+    def design_key(self, stage):
+        ''' Returns the values the design of given stage depends on. '''
+        fixed = tuple(getattr(self, k) for k in self.configuration_keys.values())
+        return stage, len(getattr(self, self.columns[0])), fixed
 
-    def calibrate(self, coefs0 = [-9.815294e-1, 1.442087e-1, -2.650806e-4, 4.065385e-5]):
-        f = self.f
-        C = np.array(self.bath_cond)
-        t = np.array(self.bath_temp)
-        delta = self.CTcor
-        epsilon = self.CPcor
-        p = np.zeros_like(t)
-        coefs = self.normalise_coefs(coefs0)
-        coefs = fmin(self.cost_fun, coefs, args=(C, f, t, p, delta, epsilon),
-                     xtol=1e-7, ftol=1e-8, maxiter=100000, disp=0)
-        coefs = self.normalise_coefs(coefs, reverse=True)
-        Csensor = self.conductivity(f, t, p, coefs, delta, epsilon)
-        residuals = C-Csensor
-        self.coefs = Coefs(*coefs)
-        self.residuals = residuals
-        self.Csensor = Csensor
+    def get_design(self, stage):
+        ''' Returns the design of given stage, cached, so that refitting
+            with other point weights is fast.
+        '''
+        key = self.design_key(stage)
+        if not stage in self.designs or self.designs[stage][0] != key:
+            self.designs[stage] = key, self.design(stage)
+        return self.designs[stage][1]
+
+    def point_weights(self, n):
+        ''' Returns the weights of the n points, with excluded points set to 0. '''
+        w = np.ones(n) if self.weights is None else np.array(self.weights, dtype=float)
+        if not self.mask is None:
+            w = w*np.asarray(self.mask)
+        return w
+
+    def set_coefs(self, stage, coefs):
+        raise NotImplementedError()
+
+    def calibrate(self, loss=None):
+        ''' Fits the coefficients.
+
+        Parameters:
+        ----------
+        loss: least_squares (default), huber or tukey. If not given, the
+              loss of the previous call is used.
+        '''
+        if not loss is None:
+            self.loss = loss
+        calibrate_all([self], loss=self.loss)
+
+    def toggle_point(self, i):
+        ''' Excludes point i from the fit, or includes it again, and refits.
+            Raises ValueError, leaving the point included, if too few
+            points would remain.
+        '''
+        if self.mask is None:
+            self.mask = np.ones(len(getattr(self, self.columns[0])), dtype=bool)
+        self.mask[i] = not self.mask[i]
+        try:
+            self.calibrate()
+        except ValueError:
+            self.mask[i] = not self.mask[i]
+            raise
 
     def report(self, glider, fp=None):
         if not fp is None:
@@ -116,25 +523,279 @@ class ConductivityCalibration(object):
         self.__report(glider, sys.stdout)
             
     def __report(self, glider, fp):
-        s = f"Calibration coefficients {glider.capitalize()}:\n"
+        s = f"{self.title} {glider.capitalize()}:\n"
         fp.write(s)
         fp.write("-"*len(s)+'\n')
-        fp.write(f"g : {self.coefs.g}\n")
-        fp.write(f"h : {self.coefs.h}\n")
-        fp.write(f"i : {self.coefs.i}\n")
-        fp.write(f"j : {self.coefs.j}\n")
+        for k, v in self.coefs._asdict().items():
+            fp.write(f"{k} : {v}\n")
+        for k, v in getattr(self, 'fitted', {}).items():
+            fp.write(f"{k} : {v} (fitted)\n")
+        if self.loss != 'least_squares':
+            fp.write(f"loss : {self.loss}\n")
+        if not self.mask is None and not np.all(self.mask):
+            fp.write(f"excluded points : {np.flatnonzero(~np.asarray(self.mask)).tolist()}\n")
         fp.write("\n")
 
-    def graph(self, glider,  f=None, ax=None):
+    def graph(self, glider,  f=None, ax=None, interactive=True):
+        ''' Plots the reference values and the residuals.
+
+        If interactive, the report is shown in the upper panel, and
+        clicking a point in the residual plot excludes it from the fit (or
+        includes it again). The fit, the plot and the report are updated
+        immediately.
+        '''
         if f is None or ax is None:
             f, ax = plt.subplots(2,1,sharex=True)
-        ax[0].plot(self.bath_cond, label=f'Bath conductivity ({glider})')
-        #ax[0].plot(self.Csensor, label=f'Sensor conductivity ({glider})')
-        ax[1].plot(self.residuals, label=glider.capitalize())
-        ax[0].set_ylabel('Conductivity (S/m)')
-        ax[1].set_ylabel('Residual (S/m)')
+        ax[0].plot(getattr(self, self.reference), label=f'{self.label} ({glider})')
+        line, = ax[1].plot(self.residuals, label=glider.capitalize())
+        included, = ax[1].plot([], [], 'o', color=line.get_color(), picker=5)
+        excluded, = ax[1].plot([], [], 'x', color='r', picker=5)
+        text = None
+        if interactive:
+            text = ax[0].text(0.01, 0.98 - 0.3*len(ax[0].texts), "", transform=ax[0].transAxes,
+                              va='top', family='monospace', fontsize='small')
+        self.artists = dict(line=line, included=included, excluded=excluded, text=text)
+        self.update_graph(glider)
+        ax[0].set_ylabel(self.ylabel)
+        ax[1].set_ylabel(f"Residual ({self.unit})")
         ax[1].set_xlabel('Measurement number')
-        ax[1].set_ylim(-1e-3, 1e-3)
-        ax[0].legend()
+        ax[1].set_ylim(-self.residual_limit, self.residual_limit)
+        ax[0].legend(loc='lower right')
         ax[1].legend()
+        if interactive:
+            f.canvas.mpl_connect('pick_event', partial(self.on_pick, glider))
         return f, ax
+
+    def update_graph(self, glider):
+        mask = np.ones(len(self.residuals), dtype=bool) if self.mask is None else np.asarray(self.mask)
+        i = np.arange(len(self.residuals))
+        self.artists['line'].set_ydata(self.residuals)
+        self.artists['included'].set_data(i[mask], self.residuals[mask])
+        self.artists['excluded'].set_data(i[~mask], self.residuals[~mask])
+        if self.artists['text']:
+            fp = io.StringIO()
+            self.__report(glider, fp)
+            self.artists['text'].set_text(fp.getvalue())
+
+    def on_pick(self, glider, event):
+        if not event.artist in (self.artists['included'], self.artists['excluded']):
+            return
+        i = int(event.artist.get_xdata()[event.ind[0]])
+        try:
+            self.toggle_point(i)
+        except ValueError as e:
+            print(f"Cannot exclude point {i}: {e}")
+            return
+        self.update_graph(glider)
+        self.report(glider)
+        event.canvas.draw_idle()
+
+
+class ConductivityCalibration(Calibration):
+    columns = 'bath_temp bath_cond inst_freq'.split()
+    configuration_keys = dict(WBOTC='WBOTC', CPCOR='CPcor', CTCOR='CTcor')
+    reference = 'bath_cond'
+    label = 'Bath conductivity'
+    ylabel = 'Conductivity (S/m)'
+    unit = 'S/m'
+    residual_limit = 1e-3
+
+    def __init__(self):
+        super().__init__()
+        self.WBOTC = 4.7841e-7
+        self.CPcor = -9.57e-8
+        self.CTcor = 3.25e-5
+        # parameters fitted besides g, h, i and j (CTcor and/or WBOTC), and
+        # their fitted values. The attributes CTcor and WBOTC keep the
+        # nominal values, from which every fit starts.
+        self.free = ()
+        self.fitted = {}
+
+    def parameters(self):
+        ''' Returns the values of CTcor, CPcor and WBOTC of the fit: the
+            fitted ones and the nominal values of the others.
+        '''
+        return dict(dict(CTcor=self.CTcor, CPcor=self.CPcor, WBOTC=self.WBOTC), **self.fitted)
+
+    def conductivity(self, f, t, p, coefs, delta, epsilon):
+        g,h, i, j = coefs
+        C = (g + h*f**2 + i*f**3 + j*f**4)/(1+delta*t + epsilon*p)
+        return C
+
+    @property
+    def f(self):
+        t = np.array(self.bath_temp)
+        f = np.array(self.inst_freq) * np.sqrt(1.0 + self.parameters()['WBOTC']*t)/1000.0
+        return f
+
+    def design(self, stage):
+        # C (1 + delta t + epsilon p) = g + h f^2 + i f^3 + j f^4 is linear in
+        # the coefficients. Weighting by 1/(1 + delta t + epsilon p)^2 makes
+        # the fit minimise the residuals in conductivity.
+        f = self.f
+        C = np.array(self.bath_cond)
+        t = np.array(self.bath_temp)
+        p = np.zeros_like(t)
+        D = 1 + self.parameters()['CTcor']*t + self.CPcor*p
+        A = np.vstack([np.ones_like(f), f**2, f**3, f**4]).T
+        return A, C*D, 1/D**2
+
+    def set_coefs(self, stage, coefs):
+        C = np.array(self.bath_cond)
+        t = np.array(self.bath_temp)
+        p = np.zeros_like(t)
+        Csensor = self.conductivity(self.f, t, p, coefs, self.parameters()['CTcor'], self.CPcor)
+        self.coefs = Coefs(*coefs)
+        self.residuals = C-Csensor
+        self.Csensor = Csensor
+
+    def design_key(self, stage):
+        return super().design_key(stage) + (tuple(sorted(self.fitted.items())),)
+
+    def model_arguments(self, weights=None):
+        ''' Returns the arguments of fit_conductivity_model(), except free,
+            with the nominal CTcor and WBOTC.
+        '''
+        t = np.array(self.bath_temp)
+        if weights is None:
+            weights = self.point_weights(t.shape[0])
+        return (np.array(self.inst_freq), t, np.zeros_like(t), np.array(self.bath_cond),
+                weights, self.WBOTC, self.CPcor, self.CTcor)
+
+    def calibrate(self, coefs0=None, loss=None, free=None, max_iterations=50):
+        ''' Fits the coefficients g, h, i and j. As the fit is linear, an
+            initial estimate coefs0 is not needed, and ignored.
+
+        Parameters:
+        ----------
+        loss: see Calibration.calibrate()
+        free: names of the parameters to fit as well, CTcor and/or WBOTC.
+              The fit is then nonlinear, and solved by Levenberg-Marquardt,
+              starting from their nominal values. The fitted values are
+              kept in fitted. If not given, the parameters of the previous
+              call are fitted.
+        '''
+        if not free is None:
+            self.free = tuple(free)
+        self.fitted = {}
+        if not self.free:
+            super().calibrate(loss)
+            return
+        if not loss is None:
+            self.loss = loss
+        w = self.point_weights(len(self.bath_temp))
+        n_coefs = 4 + len(self.free)
+        if np.count_nonzero(w) < n_coefs:
+            raise ValueError(f"{np.count_nonzero(w)} points included, at least "
+                             f"{n_coefs} are needed to fit {n_coefs} coefficients")
+        F, t, p, C = np.array(self.inst_freq), np.array(self.bath_temp), np.zeros(len(w)), np.array(self.bath_cond)
+
+        def residuals(fit):
+            f = F*np.sqrt(1 + fit.WBOTC*t)/1000
+            return (C - self.conductivity(f, t, p, fit.coefs, fit.CTcor, self.CPcor))*np.sqrt(w)
+
+        fit, rw = reweighted_fit(lambda rw: fit_conductivity_model(*self.model_arguments(w*rw), self.free),
+                                 residuals, w>0, self.loss, n_coefs, max_iterations,
+                                 coefs=lambda fit: np.hstack([fit.coefs, fit.CTcor, fit.WBOTC]))
+        self.robust_weights = rw
+        self.fitted = dict((k, float(getattr(fit, k))) for k in fit.free)
+        self.set_coefs(0, fit.coefs)
+
+
+class TemperatureCalibration(Calibration):
+    columns = 'bath_temp inst_counts'.split()
+    title = "Temperature calibration coefficients"
+    reference = 'bath_temp'
+    label = 'Bath temperature'
+    ylabel = 'Temperature (degC)'
+    unit = 'degC'
+    residual_limit = 2e-3
+
+    @staticmethod
+    def log_resistance(n):
+        ''' Log of the thermistor resistance from the temperature counts. '''
+        mv = (np.asarray(n) - 524288)/1.6e7
+        r = (mv*2.900e9 + 1.024e8)/(2.048e4 - mv*2.0e5)
+        return np.log(r)
+
+    def temperature(self, n, coefs):
+        L = self.log_resistance(n)
+        a0, a1, a2, a3 = coefs
+        return 1/(a0 + a1*L + a2*L**2 + a3*L**3) - 273.15
+
+    def design(self, stage):
+        # 1/(T + 273.15) = a0 + a1 L + a2 L^2 + a3 L^3, weighted by
+        # (T + 273.15)^4 to minimise the residuals in temperature.
+        L = self.log_resistance(self.inst_counts)
+        K = np.array(self.bath_temp) + 273.15
+        A = np.vstack([np.ones_like(L), L, L**2, L**3]).T
+        return A, 1/K, K**4
+
+    def set_coefs(self, stage, coefs):
+        self.coefs = TemperatureCoefs(*coefs)
+        self.Tsensor = self.temperature(self.inst_counts, coefs)
+        self.residuals = np.array(self.bath_temp) - self.Tsensor
+
+
+class PressureCalibration(Calibration):
+    ''' Pressure calibration. The coefficients of the temperature of the
+        pressure sensor (PTEMPA0-2) are fitted first, then PA0-2. The
+        temperature compensation coefficients (PTCA0-2, PTCB0-2) are taken
+        from the configuration file of the instrument.
+    '''
+    columns = 'bath_temp ref_pres inst_counts inst_temp_counts'.split()
+    configuration_keys = dict((k, k) for k in 'PTCA0 PTCA1 PTCA2 PTCB0 PTCB1 PTCB2'.split())
+    n_stages = 2
+    title = "Pressure calibration coefficients"
+    reference = 'ref_pres'
+    label = 'Reference pressure'
+    ylabel = 'Pressure (psia)'
+    unit = 'psia'
+    residual_limit = 0.5
+
+    def __init__(self):
+        super().__init__()
+        self.PTCA0 = 5.250772e+05
+        self.PTCA1 = 2.016446e+00
+        self.PTCA2 = -2.519739e-02
+        self.PTCB0 = 2.620388e+01
+        self.PTCB1 = 1.750000e-04
+        self.PTCB2 = 0.
+
+    def sensor_temperature(self, y, ptempa):
+        a0, a1, a2 = ptempa
+        y = np.asarray(y)
+        return a0 + a1*y + a2*y**2
+
+    def compensated_counts(self, x, t):
+        x = np.asarray(x) - self.PTCA0 - self.PTCA1*t - self.PTCA2*t**2
+        return x*self.PTCB0/(self.PTCB0 + self.PTCB1*t + self.PTCB2*t**2)
+
+    def pressure(self, x, y, coefs):
+        pa0, pa1, pa2, *ptempa = coefs
+        n = self.compensated_counts(x, self.sensor_temperature(y, ptempa))
+        return pa0 + pa1*n + pa2*n**2
+
+    def design(self, stage):
+        if stage == 0:
+            y = np.array(self.inst_temp_counts)
+            A = np.vstack([np.ones_like(y), y, y**2]).T
+            return A, np.array(self.bath_temp), np.ones_like(y)
+        t = self.sensor_temperature(self.inst_temp_counts, self.ptempa)
+        n = self.compensated_counts(self.inst_counts, t)
+        A = np.vstack([np.ones_like(n), n, n**2]).T
+        return A, np.array(self.ref_pres), np.ones_like(n)
+
+    def design_key(self, stage):
+        key = super().design_key(stage)
+        if stage == 1:
+            key += (tuple(self.ptempa),)
+        return key
+
+    def set_coefs(self, stage, coefs):
+        if stage == 0:
+            self.ptempa = coefs
+            return
+        self.coefs = PressureCoefs(*coefs, *self.ptempa)
+        self.Psensor = self.pressure(self.inst_counts, self.inst_temp_counts, self.coefs)
+        self.residuals = np.array(self.ref_pres) - self.Psensor
@@ -0,0 +1,175 @@
+import json
+import multiprocessing as mp
+import os
+import time
+
+import numpy as np
+
+from . import calibration
+
+# Calibration certificates of conductivity sensors. For each instrument a
+# page (coefficients, table of calibration points and residuals, residual
+# plot) is written as PDF and/or SVG, together with a JSON file holding the
+# same information and the model evaluated over a grid of instrument
+# frequency and temperature.
+#
+# The models of all instruments are evaluated over the grid in one
+# vectorized pass. The pages are rendered in a process pool, as rendering
+# dominates the time taken.
+
+
+def evaluate_grid(calibrations, temperatures=np.arange(-2., 33., 2.), n_frequencies=50):
+    ''' Evaluates the conductivity models of a number of instruments over
+        a grid of temperature and instrument frequency.
+
+    Parameters:
+    ----------
+    calibrations: list of fitted calibration.ConductivityCalibration instances
+    temperatures: temperatures of the grid (degree C)
+    n_frequencies: number of frequencies, spanning the frequencies
+                   measured by each instrument during calibration
+
+    Returns:
+    --------
+    frequencies (n_instruments x n_frequencies), and conductivity
+    (n_instruments x n_temperatures x n_frequencies)
+    '''
+    coefs = np.array([c.coefs for c in calibrations])
+    CTcor, CPcor, WBOTC = (np.array([c.parameters()[k] for c in calibrations])[:, None, None]
+                           for k in ('CTcor', 'CPcor', 'WBOTC'))
+    F0, F1 = (np.array([fn(c.inst_freq) for c in calibrations]) for fn in (np.min, np.max))
+    u = np.linspace(0, 1, n_frequencies)
+    F = F0[:, None] + (F1 - F0)[:, None]*u
+    t = np.asarray(temperatures, dtype=float)[None, :, None]
+    p = np.zeros_like(t)
+    f = F[:, None, :]*np.sqrt(1 + WBOTC*t)/1000
+    g, h, i, j = (coefs[:, k, None, None] for k in range(4))
+    C = (g + h*f**2 + i*f**3 + j*f**4)/(1 + CTcor*t + CPcor*p)
+    return F, C
+
+
+def certificate_data(c, name, frequencies, conductivity, temperatures, date):
+    ''' Returns the contents of the certificate of a fitted calibration, as a
+        JSON serialisable dictionary.
+    '''
+    mask = np.ones(len(c.residuals), dtype=bool) if c.mask is None else np.asarray(c.mask)
+    return dict(instrument=name,
+                date=date,
+                coefficients=dict((k, float(v)) for k, v in c.coefs._asdict().items()),
+                parameters=dict((k, float(v)) for k, v in c.parameters().items()),
+                fitted=['g', 'h', 'i', 'j'] + list(c.free),
+                loss=c.loss,
+                points=dict(bath_temp=list(map(float, c.bath_temp)),
+                            bath_cond=list(map(float, c.bath_cond)),
+                            inst_freq=list(map(float, c.inst_freq)),
+                            inst_cond=c.Csensor.tolist(),
+                            residual=c.residuals.tolist(),
+                            included=mask.tolist()),
+                rms_residual=float(np.sqrt(np.mean(c.residuals[mask]**2))),
+                grid=dict(bath_temp=np.asarray(temperatures, dtype=float).tolist(),
+                          inst_freq=frequencies.tolist(),
+                          conductivity=conductivity.tolist()))
+
+
+def from_certificate_data(data):
+    ''' Returns a calibration.ConductivityCalibration with the data and
+        coefficients of a certificate.
+    '''
+    c = calibration.ConductivityCalibration()
+    for k in c.columns:
+        setattr(c, k, data['points'][k])
+    for k, v in data['parameters'].items():
+        setattr(c, k, v)
+    c.free = tuple(data['fitted'][4:])
+    c.fitted = dict((k, data['parameters'][k]) for k in c.free)
+    c.loss = data['loss']
+    c.mask = np.array(data['points']['included'])
+    c.set_coefs(0, list(data['coefficients'].values()))
+    return c
+
+
+def render_certificate(data, directory='.', formats=('pdf', 'svg')):
+    ''' Writes the certificate page(s) and the JSON file of an instrument.
+
+    Returns:
+    --------
+    list of the files written
+    '''
+    from matplotlib.figure import Figure
+    c = from_certificate_data(data)
+    name = data['instrument']
+    fn = os.path.join(directory, f"{name}_ctd_certificate_{data['date']}")
+    f = Figure(figsize=(8.27, 11.69))
+    gs = f.add_gridspec(5, 1, height_ratios=[0.5, 1.3, 3.2, 2, 2], hspace=0.3,
+                        left=0.12, right=0.95, top=0.95, bottom=0.05)
+    title, coefs, points = (f.add_subplot(gs[k]) for k in range(3))
+    ax = [f.add_subplot(gs[3])]
+    ax.append(f.add_subplot(gs[4], sharex=ax[0]))
+    for _ax in (title, coefs, points):
+        _ax.set_axis_off()
+    title.text(0, 0.5, f"Conductivity calibration {name.capitalize()}, {data['date']}",
+               fontsize='x-large', va='center')
+    values = dict(data['coefficients'], **data['parameters'])
+    rows = [[k, f"{v:.6e}", "fitted" if k in data['fitted'] else "fixed"] for k, v in values.items()]
+    rows.append(["rms residual", f"{data['rms_residual']:.3e} S/m", data['loss']])
+    table = coefs.table(cellText=rows, colLabels=["Coefficient", "Value", ""], loc='center')
+    table.auto_set_font_size(False)
+    table.set_fontsize(8)
+    p = data['points']
+    rows = [[f"{k}", f"{T:.4f}", f"{C:.5f}", f"{F:.2f}", f"{Ci:.5f}", f"{r:.2e}", "" if included else "excluded"]
+            for k, (T, C, F, Ci, r, included) in enumerate(zip(p['bath_temp'], p['bath_cond'], p['inst_freq'],
+                                                               p['inst_cond'], p['residual'], p['included']))]
+    table = points.table(cellText=rows, loc='center',
+                         colLabels=["#", "Bath temp (degC)", "Bath cond (S/m)", "Inst freq (Hz)",
+                                    "Inst cond (S/m)", "Residual (S/m)", ""])
+    table.auto_set_font_size(False)
+    table.set_fontsize(7)
+    c.graph(name, f, ax, interactive=False)
+    files = []
+    for ext in formats:
+        f.savefig(f"{fn}.{ext}")
+        files.append(f"{fn}.{ext}")
+    with open(f"{fn}.json", 'w') as fp:
+        json.dump(data, fp, indent=1)
+    files.append(f"{fn}.json")
+    return files
+
+
+def _render_certificate(args):
+    return render_certificate(*args)
+
+
+def generate_certificates(calibrations, names, directory='.', formats=('pdf', 'svg'),
+                          date=None, processes=None, **grid_options):
+    ''' Writes the certificates of a number of fitted conductivity calibrations.
+
+    Parameters:
+    ----------
+    calibrations: list of fitted calibration.ConductivityCalibration instances
+    names: names of the instruments (gliders)
+    directory: directory to write to
+    formats: formats of the certificate pages, any supported by matplotlib
+    date: date of the certificates, default today (YYYYMMDD)
+    processes: number of worker processes, default one per instrument, up
+               to the number of cores. With 1, the pages are rendered in
+               this process.
+    grid_options: passed to evaluate_grid()
+
+    Returns:
+    --------
+    list of the files written
+    '''
+    if date is None:
+        date = time.strftime('%Y%m%d')
+    temperatures = grid_options.pop('temperatures', np.arange(-2., 33., 2.))
+    frequencies, conductivity = evaluate_grid(calibrations, temperatures, **grid_options)
+    tasks = [(certificate_data(c, name, F, C, temperatures, date), directory, formats)
+             for c, name, F, C in zip(calibrations, names, frequencies, conductivity)]
+    if processes is None:
+        processes = min(mp.cpu_count(), len(tasks))
+    if processes <= 1:
+        files = list(map(_render_certificate, tasks))
+    else:
+        with mp.get_context('spawn').Pool(processes) as pool:
+            files = pool.map(_render_certificate, tasks)
+    return [fn for _files in files for fn in _files]
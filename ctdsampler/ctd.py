@@ -1,22 +1,138 @@
 import serial_asyncio
 import asyncio
+from collections import deque
+import time
 
-class CTDInterface(asyncio.Protocol):
+OVERLOAD_POLICIES = ('drop-oldest', 'drop-newest', 'coalesce')
+
+
+def is_sample(s):
+    ''' Returns True if s looks like a data line (6 or 7 comma separated
+        values). Only the commas are counted, the values are parsed by
+        the LineParser.
+    '''
+    return s.count(",") in (5, 6)
+
+
+def parse_sample(s):
+    ''' Parses a data line
+
+    Returns:
+    --------
+    (c, t, d, dt, P, T) if s is a data line (dt is None for converted
+    output), else None
+    '''
+    try:
+        data_in = [float(x) for x in s.strip().split(",")]
+    except ValueError:
+        return None
+    if len(data_in) == 6:
+        d, t, c, T, P, H = data_in
+        return (c, t, d, None, P, T)
+    elif len(data_in) == 7:
+        d, t, c, dt, T, P, H = data_in
+        return (c, t, d, dt, P, T)
+    return None
+
+
+class SampleQueue(asyncio.Queue):
+    ''' Bounded queue to pass lines from the CTD interface to the user interface.
+
+        The number of data lines in the queue is limited to size. If the
+        queue is full, a new data line is handled according to the overload
+        policy:
+
+        drop-oldest: the oldest data line in the queue is dropped.
+        drop-newest: the new data line is dropped.
+        coalesce   : the newest data line in the queue is dropped, and the
+                     new one is queued, so that the latest values of all
+                     channels are always shown.
+
+        Other lines (command responses and calibration dumps, which are
+        written to disk) are never dropped.
+    '''
+    def __init__(self, size=1000, policy='drop-oldest'):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy: {policy}")
+        if size < 1:
+            raise ValueError(f"Queue size must be at least 1, not {size}")
+        super().__init__()
+        self.size = size
+        self.policy = policy
+        self.dropped = dict((k, 0) for k in OVERLOAD_POLICIES)
+        self.n_samples = 0
+        self.flags = deque()
+
+    def _get(self):
+        self.n_samples -= self.flags.popleft()
+        return super()._get()
+
+    def put_nowait(self, item):
+        sample = is_sample(item)
+        if sample and self.n_samples >= self.size:
+            self.dropped[self.policy]+=1
+            if self.policy == 'drop-newest':
+                return
+            elif self.policy == 'coalesce':
+                # the new line goes to the end of the queue, after the
+                # other lines received before it.
+                i = len(self.flags) - 1
+                while not self.flags[i]:
+                    i-=1
+            else:
+                i = self.flags.index(True)
+            del self._queue[i]
+            del self.flags[i]
+            self.n_samples -= 1
+            # the dropped line will not be processed.
+            self.task_done()
+        self.flags.append(sample)
+        self.n_samples += sample
+        super().put_nowait(item)
+
+def decode(data):
+    ''' Converts the bytes received from the CTD to a string, skipping 0xff bytes. '''
+    return bytes(data).replace(b'\xff', b'').decode('latin-1')
+
+
+class LineFramer(object):
+    ''' Splits the characters received from the CTD into lines. '''
     RETURN = '\r\n'
 
+    def __init__(self):
+        self.buf = ''
+
+    def feed(self, s):
+        ''' Adds s to the buffer
+
+        Returns:
+        --------
+        list of the complete, non-empty, lines in the buffer.
+        '''
+        self.buf+=s
+        if not self.RETURN in self.buf:
+            return []
+        buf = self.buf.split(self.RETURN)
+        self.buf = buf.pop()
+        return [_buf for _buf in buf if _buf]
+
+
+class CTDInterface(asyncio.Protocol):
+    # archive.ArchiveWriter and reference.ReferenceRecorder, which receive
+    # all samples, with the time they arrived, before the overload policy
+    # of the queue is applied.
+    archive = None
+    reference = None
+
     def __init__(self, *p, **k):
         super().__init__(*p, **k)
-        self.buf = ''
+        self.framer = LineFramer()
                         
     def connection_made(self, transport):
         self.transport = transport
 
     def data_received(self, data):
-        s = []
-        for i in data:
-            if i<255:
-                s.append(chr(i))
-        self.consume("".join(s))
+        self.consume(decode(data))
 
     def connection_lost(self, exc):
         asyncio.get_event_loop().stop()
@@ -26,23 +142,38 @@ class CTDInterface(asyncio.Protocol):
         self.transport.write(mesg.encode())
 
     def consume(self, s):
-        self.buf+=s
-        if self.RETURN in self.buf:
-            buf = self.buf.split(self.RETURN)
-            n = len(buf) - int(not self.buf.endswith(self.RETURN))
-            for i in range(n):
-                _buf = buf.pop(0)
-                if _buf:
-                    self.queue.put_nowait(_buf)
-            self.buf = ''.join(buf)
+        t = time.time()
+        for _buf in self.framer.feed(s):
+            if self.archive or self.reference:
+                sample = parse_sample(_buf)
+                if sample and self.archive:
+                    self.archive.append(t, sample)
+                if sample and self.reference:
+                    self.reference.add_sample(t, sample)
+            self.queue.put_nowait(_buf)
+
+
+class PipelineCTDInterface(CTDInterface):
+    ''' CTD interface for pipeline mode. The data received are passed
+        unprocessed to a pipeline.ParserWorker (set as queue), which does
+        the framing and parsing in a separate process, and returns the
+        samples to archive and to pass to the reference recorder.
+    '''
+    def data_received(self, data):
+        self.queue.put_nowait(data)
             
 
 # a coroutine to start up the serial interface.
-async def start_serial_interface(loop, queue, interface, device, baudrate):
+# queue receives the lines read (CTDInterface), or the raw data (PipelineCTDInterface).
+# archive and reference, if given, receive all samples (CTDInterface).
+async def start_serial_interface(loop, queue, interface, device, baudrate, archive=None,
+                                 reference=None):
     coro = serial_asyncio.create_serial_connection(loop, interface,
                                                    device, baudrate,
                                                    rtscts=False, xonxoff=True, dsrdtr=False)
     transport, protocol = await coro
     protocol.loop = loop
     protocol.queue = queue
+    protocol.archive = archive
+    protocol.reference = reference
     return protocol
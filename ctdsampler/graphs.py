@@ -2,24 +2,36 @@ from collections import deque
 from functools import partial
 
 import multiprocessing as mp
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 import logging
 
+from . import profiling
+
 logger = mp.log_to_stderr()
 logger.setLevel(logging.CRITICAL)
 #logger.setLevel(logging.INFO)
 
+# Axis labels, for converted and raw output, of the six channels c t d dt P T
+LABELS = dict(converted=["C (S/m)", "T (degC)", "P (bar)", "-", "Pinternal (Pa)", "Tinternal (degC)"],
+              raw=["P1 (counts)", "P2 (counts)", "P3 (counts)", "P4 (counts)", "Pinternal (Pa)", "Tinternal (degC)"])
+
 # Process Plotter, a cllas to plot data receiving from a pipe
 # the methods plot_init and plot_update are to be subclassed.
+#
+# matplotlib is imported in the methods that run in the plot process only,
+# so that the main process does not need to import it.
 
 class ProcessPlotter:
     def __init__(self, **options):
         self.options = options
         self.command_bindings = {}
         self.add_command_binding(command = 'close', callback=self.terminate, return_value=False)
+        self.add_command_binding('profile_on', self.start_profiling, True)
+        self.add_command_binding('profile_off', self.stop_profiling, True)
+        self.profiler = None
         
     def plot_init(self):
         raise NotImplementedError()
@@ -31,8 +43,21 @@ class ProcessPlotter:
         raise NotImplementedError()
     
     def terminate(self):
+        import matplotlib.pyplot as plt
+        if self.profiler and self.profiler.is_running:
+            self.profiler.stop()
         plt.close('all')
 
+    def start_profiling(self):
+        if self.profiler is None:
+            self.profiler = profiling.Profiler('plot')
+        if not self.profiler.is_running:
+            self.profiler.start()
+
+    def stop_profiling(self):
+        if self.profiler and self.profiler.is_running:
+            self.profiler.stop()
+
     def add_command_binding(self, command, callback, return_value=True):
         self.command_bindings[command] = (callback, return_value)
         
@@ -59,7 +84,10 @@ class ProcessPlotter:
         return return_value
             
     def __call__(self, pipe):
+        import matplotlib.pyplot as plt
         self.pipe = pipe
+        if profiling.is_enabled_by_environment():
+            self.start_profiling()
         self.plot_init()
         timer = self.fig.canvas.new_timer(interval=50)
         timer.add_callback(self.call_back)
@@ -113,6 +141,7 @@ class FourPanelPlotter(ProcessPlotter):
             artist.set_data(x,y)
 
     def plot_init(self):
+        import matplotlib.pyplot as plt
         N = self.options['N']
         self.data = {'P' : deque(maxlen=N),
                      'T' : deque(maxlen=N),
@@ -157,17 +186,185 @@ class FourPanelPlotter(ProcessPlotter):
         for label, ax in zip(self.options['labels'][label_type], self.ax):
             ax.set_ylabel(label)
 
-class Graph(object):
-    def __init__(self, N=100):
-        labels = dict(converted=["C (S/m)", "T (degC)", "P (bar)", "-", "Pinternal (Pa)", "Tinternal (degC)"],
-                      raw=["P1 (counts)", "P2 (counts)", "P3 (counts)", "P4 (counts)", "Pinternal (Pa)", "Tinternal (degC)"])
-        plotter = FourPanelPlotter(N=N, labels=labels)
+class PlotBackend(object):
+    ''' Interface of the plot backends used by Graph.
+
+        A backend that draws in the terminal provides an urwid widget, which
+        is included in the user interface, and is rendered by the UI's frame
+        timer through render().
+    '''
+    widget = None
+
+    def plot(self, *p):
+        raise NotImplementedError()
+
+    def plot_points(self, *p):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def adjust_axes(self):
+        raise NotImplementedError()
+
+    def set_labels(self, label_type):
+        raise NotImplementedError()
+
+    def render(self):
+        pass
+
+    def set_profiling(self, on):
+        pass
+
+    def needs_restart(self):
+        ''' Returns True if the plot has gone (the window was closed). '''
+        return False
+
+    def restart(self):
+        pass
+
+    def status(self):
+        ''' Returns a text to show in the status, or None. '''
+        return None
+
+
+class ProcessBackend(PlotBackend):
+    ''' Plot backend sending the data to a ProcessPlotter in a separate process.
+
+        If the plot window is closed, the plot process ends, and data are discarded
+        until it is restarted by Graph.render().
+
+        A plot process that ends within quick_exit seconds of its start
+        (for instance, as no window can be shown) is restarted after
+        restart_interval seconds, doubled at each such exit in a row, and
+        is not restarted anymore after max_quick_exits of them.
+    '''
+    restart_interval = 5.
+    quick_exit = 10.
+    max_quick_exits = 3
+
+    def __init__(self, plotter):
+        self.plotter = plotter
         self.plot_process, self.plot_pipe = create_plot_process(plotter)
+        self.is_closed = False
+        self.started = time.time()
+        # time the plot process was found ended, and number of quick exits
+        # in a row
+        self.exited = None
+        self.n_quick_exits = 0
+        # profiling state, sent again to a restarted plot process
+        self.profiling = profiling.is_enabled_by_environment()
+
+    def send(self, message):
+        try:
+            self.plot_pipe.send(message)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def has_given_up(self):
+        return self.n_quick_exits >= self.max_quick_exits
+
+    def needs_restart(self):
+        if self.is_closed or self.plot_process.is_alive():
+            return False
+        now = time.time()
+        if self.exited is None:
+            self.exited = now
+            if now - self.started < self.quick_exit:
+                self.n_quick_exits += 1
+            else:
+                self.n_quick_exits = 0
+        if self.has_given_up():
+            return False
+        delay = 0
+        if self.n_quick_exits:
+            delay = self.restart_interval * 2**(self.n_quick_exits - 1)
+        return now - self.exited >= delay
+
+    def restart(self):
+        self.plot_pipe.close()
+        self.plot_process, self.plot_pipe = create_plot_process(self.plotter)
+        self.started = time.time()
+        self.exited = None
+        self.set_profiling(self.profiling)
+
+    def status(self):
+        if self.has_given_up():
+            return "plot window: gave up"
+        return None
+
+    def plot(self, *p):
+        self.send(('data',p))
+
+    def plot_points(self, *p):
+        self.send(('data_points',p))
+
+    def close(self):
+        self.is_closed = True
+        self.send(('command', "close"))
+
+    def clear(self):
+        self.send(('command', "clear"))
+
+    def adjust_axes(self):
+        self.send(('command', 'adjust_axes'))
+
+    def set_labels(self, label_type):
+        self.send(('command', 'set_labels_%s'%(label_type)))
+
+    def set_profiling(self, on):
+        self.profiling = on
+        self.send(('command', 'profile_on' if on else 'profile_off'))
+
+
+def create_backend(backend, N):
+    ''' Factory function to create a plot backend
+
+    Parameters:
+    ----------
+    backend: 'matplotlib' (plot window in a separate process) or 'terminal'
+             (sparklines in the user interface)
+    N: number of data points shown
+
+    Returns:
+    --------
+    PlotBackend instance
+    '''
+    if backend == 'terminal':
+        from .sparklines import TerminalBackend
+        return TerminalBackend(N=N, labels=LABELS)
+    elif backend == 'matplotlib':
+        return ProcessBackend(FourPanelPlotter(N=N, labels=LABELS))
+    raise ValueError(f"Unknown plot backend: {backend}")
+
+
+class Graph(object):
+    ''' Plots the averaged values (lines) and measurements (points) with
+        a plot backend.
+
+        The last N lines and points are kept, so that they can be replayed
+        when the plot process is restarted, and saved in session
+        snapshots.
+    '''
+    def __init__(self, N=100, backend='matplotlib'):
+        self.backend = create_backend(backend, N)
+        self.widget = self.backend.widget
         self.is_labels_set = False
+        self.label_type = None
+        self.lines = deque(maxlen=N)
+        self.points = deque(maxlen=N)
+        # numbers of lines and points plotted in total
+        self.n_lines = 0
+        self.n_points = 0
+        self.n_clears = 0
 
-        
     def plot(self, *p):
-        self.plot_pipe.send(('data',p))
+        self.lines.append(p)
+        self.n_lines+=1
+        self.backend.plot(*p)
         if not self.is_labels_set:
             self.is_labels_set=True
             if len(p)==5:
@@ -179,26 +376,73 @@ class Graph(object):
                 self.is_labels_set=False
                 
     def plot_points(self, *p):
-        self.plot_pipe.send(('data_points',p))
+        self.points.append(p)
+        self.n_points+=1
+        self.backend.plot_points(*p)
                 
     def close(self):
-        self.plot_pipe.send(('command', "close"))
+        self.backend.close()
 
     def clear(self):
-        self.plot_pipe.send(('command', "clear"))
+        self.lines.clear()
+        self.points.clear()
+        self.n_clears+=1
+        self.backend.clear()
         
     def adjust_axes(self):
-        self.plot_pipe.send(('command', 'adjust_axes'))
+        self.backend.adjust_axes()
 
     def set_labels(self, label_type):
-        self.plot_pipe.send(('command', 'set_labels_%s'%(label_type)))
-
-
+        self.label_type = label_type
+        self.backend.set_labels(label_type)
 
+    def render(self):
+        if self.backend.needs_restart():
+            self.backend.restart()
+            self.replay()
+        self.backend.render()
 
+    def replay(self):
+        ''' Sends the data kept to the backend. '''
+        if self.label_type:
+            self.backend.set_labels(self.label_type)
+        for p in self.lines:
+            self.backend.plot(*p)
+        for p in self.points:
+            self.backend.plot_points(*p)
+        if self.lines or self.points:
+            self.backend.adjust_axes()
 
+    def get_data(self, since=None):
+        ''' Returns the data kept, or the data plotted since the counts given.
 
+        Params:
+        -------
+        since: counts returned by a previous call
 
+        Returns:
+        --------
+        lines, points, and the counts of lines and points plotted, and of
+        clears, in total.
+        '''
+        lines, points = list(self.lines), list(self.points)
+        counts = self.n_lines, self.n_points, self.n_clears
+        if not since is None:
+            lines = lines[len(lines)-min(counts[0] - since[0], len(lines)):]
+            points = points[len(points)-min(counts[1] - since[1], len(points)):]
+        return lines, points, counts
 
+    def restore(self, lines, points, label_type=None):
+        ''' Restores the data kept, and plots them. '''
+        self.lines.extend(lines)
+        self.points.extend(points)
+        if label_type:
+            self.label_type = label_type
+            self.is_labels_set = True
+        self.replay()
 
+    def set_profiling(self, on):
+        self.backend.set_profiling(on)
 
+    def status(self):
+        return self.backend.status()
@@ -0,0 +1,261 @@
+from collections import deque
+import multiprocessing as mp
+import os
+from queue import SimpleQueue
+import threading
+import time
+
+import numpy as np
+
+from . import archive
+from . import ctd
+from . import profiling
+from .ui import LineParser, RunningAverager, format_values
+
+# Pipeline mode: the framing, parsing and averaging of the data received
+# from the CTD are done in a worker process, so that they do not compete
+# with the user interface for the GIL. The event loop passes the data
+# received to the worker through a pipe, and the worker returns the results
+# in batches through another pipe, which the event loop watches
+# (add_reader). The event loop is left with rendering, plotting the latest
+# values and handling key presses.
+#
+# The worker applies the overload policy of the queue. Samples that pass it
+# are all returned (if collect_samples is set), for the broadcast server,
+# so none are lost between the worker and the event loop. If
+# record_samples is set, all samples received, before the overload policy
+# is applied, are returned with the time they arrived, for the archive and
+# the reference recorder.
+
+
+class Batch(object):
+    ''' Output of the worker, to be shown by UI.apply_batch().
+
+        Only the lines that fit in the Monitor and Results fields, and the
+        values that fit in the graph, are kept. The numbers of lines
+        processed are counted in n_lines and n_results.
+    '''
+    def __init__(self, n_monitor, n_results, n_plot):
+        self.lines = deque(maxlen=n_monitor)
+        self.results = deque(maxlen=n_results)
+        # running averages and measurements to plot
+        self.values = deque(maxlen=n_plot)
+        self.points = deque(maxlen=n_plot)
+        # all samples (if collected), and all samples received, as rows of
+        # the archive (if recorded)
+        self.samples = []
+        self.received = []
+        self.dumps = []
+        self.n_lines = 0
+        self.n_results = 0
+        self.dump_started = False
+        self.israwoutput = False
+        # state of the running averagers and drop counts of the queue, at
+        # the end of the batch
+        self.averagers = None
+        self.dropped = None
+
+
+class Worker(object):
+    ''' The worker, running in the worker process. '''
+    lines_per_slice = 50
+    messages_per_slice = 100
+    niceness = 10
+
+    def __init__(self, inbox, outbox, size, policy, batch_sizes, collect_samples, record_samples,
+                 batch_interval):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.queue = ctd.SampleQueue(size, policy)
+        self.ra = dict((k, RunningAverager()) for k in 'c t d dt P T'.split())
+        self.parser = LineParser(self.ra)
+        self.framer = ctd.LineFramer()
+        self.batch_sizes = batch_sizes
+        self.collect_samples = collect_samples
+        self.record_samples = record_samples
+        self.batch_interval = batch_interval
+        self.batch = Batch(*batch_sizes)
+        self.t_sent = time.time()
+        self.profiler = profiling.Profiler('worker')
+        # batches are sent by a separate thread, so that the worker keeps
+        # reading its inbox while the event loop is busy.
+        self.outgoing = SimpleQueue()
+        self.sender = threading.Thread(target=self.send, daemon=True)
+
+    def send(self):
+        while True:
+            batch = self.outgoing.get()
+            if batch is None:
+                break
+            self.outbox.send(batch)
+
+    def run(self):
+        # the user interface takes precedence when they share a core.
+        os.nice(self.niceness)
+        self.outbox.send(None)
+        self.sender.start()
+        if profiling.is_enabled_by_environment():
+            self.profiler.start()
+        while True:
+            # block only if there is nothing left to do.
+            timeout = None if self.queue.empty() else 0
+            n = 0
+            while n < self.messages_per_slice and self.inbox.poll(timeout):
+                n+=1
+                message, data = self.inbox.recv()
+                if message == 'stop':
+                    self.process_lines()
+                    self.hand_over()
+                    if self.profiler.is_running:
+                        self.profiler.stop()
+                    self.outgoing.put(None)
+                    self.sender.join()
+                    return
+                self.handle(message, data)
+                timeout = 0
+            self.process_lines(self.lines_per_slice)
+            if self.queue.empty() or time.time() - self.t_sent > self.batch_interval:
+                self.hand_over()
+
+    def handle(self, message, data):
+        if message == 'data':
+            t, data = data
+            for s in self.framer.feed(ctd.decode(data)):
+                if self.record_samples:
+                    sample = ctd.parse_sample(s)
+                    if sample:
+                        self.batch.received.append(archive.to_row(t, sample))
+                self.queue.put_nowait(s)
+        elif message == 'reset':
+            self.process_lines()
+            self.parser.reset()
+        elif message == 'averagers':
+            for k, (n, xp) in data.items():
+                self.ra[k].k = n
+                self.ra[k].xp = xp
+        elif message == 'profile':
+            if data and not self.profiler.is_running:
+                self.profiler.start()
+            elif not data and self.profiler.is_running:
+                self.profiler.stop()
+
+    def process_lines(self, n=None):
+        ''' Processes n lines from the queue, or all. '''
+        batch = self.batch
+        while not self.queue.empty() and n != 0:
+            if n:
+                n-=1
+            s = self.queue.get_nowait()
+            parsed = self.parser.parse(s)
+            batch.lines.append(s)
+            batch.n_lines+=1
+            if parsed.sample:
+                batch.results.append(format_values(parsed.values))
+                batch.n_results+=1
+                batch.values.append(parsed.values)
+                batch.points.append(parsed.sample)
+                if self.collect_samples:
+                    batch.samples.append(parsed.sample)
+                batch.israwoutput = not parsed.sample[3] is None
+            if parsed.dump_started:
+                batch.dump_started = True
+                batch.results.clear()
+            if parsed.dump:
+                batch.dumps.append(parsed.dump)
+
+    def hand_over(self):
+        if not self.batch.n_lines and not self.batch.received:
+            return
+        batch = self.batch
+        # an array is sent much faster than a list of tuples.
+        batch.received = np.array(batch.received, dtype=float)
+        batch.averagers = dict((k, (ra.k, ra.xp)) for k, ra in self.ra.items())
+        batch.dropped = dict(self.queue.dropped)
+        self.outgoing.put(batch)
+        self.batch = Batch(*self.batch_sizes)
+        self.t_sent = time.time()
+
+
+def run_worker(*p):
+    Worker(*p).run()
+
+
+class ParserWorker(object):
+    ''' Runs the framing, parsing and averaging of the data received from
+        the CTD in a worker process.
+    '''
+    def __init__(self, loop, queue, callback, n_monitor, n_results, n_plot,
+                 collect_samples=False, record_samples=False, batch_interval=0.05):
+        ''' Constructor
+
+        Params:
+        -------
+        loop: asyncio event loop
+        queue: ctd.SampleQueue, of which the size and overload policy are
+               applied by the worker. Its drop counts are updated with
+               each batch.
+        callback: function called, on the event loop, with each Batch.
+        n_monitor: number of lines of the Monitor field
+        n_results: number of lines of the Results field
+        n_plot: number of values shown by the graph
+        collect_samples: if True, all samples are returned in the batches
+        record_samples: if True, all samples received, also those dropped
+                        by the overload policy, are returned in the
+                        batches, as rows of the archive (with the time
+                        they arrived).
+        batch_interval: maximum time (s) between batches, when the worker
+                        does not keep up.
+        '''
+        self.loop = loop
+        self.queue = queue
+        self.callback = callback
+        inbox, self.inbox = mp.Pipe(duplex=False)
+        self.outbox, outbox = mp.Pipe(duplex=False)
+        self.process = mp.get_context('spawn').Process(
+            target=run_worker, daemon=True,
+            args=(inbox, outbox, queue.size, queue.policy, (n_monitor, n_results, n_plot),
+                  collect_samples, record_samples, batch_interval))
+
+    def start(self):
+        self.process.start()
+        # wait for the worker to be ready, rather than blocking on a full
+        # pipe once the data arrive.
+        self.outbox.recv()
+        self.loop.add_reader(self.outbox.fileno(), self.receive)
+
+    def receive(self, timeout=0):
+        ''' Hands the batches received from the worker to the callback. '''
+        while self.outbox.poll(timeout):
+            try:
+                batch = self.outbox.recv()
+            except EOFError:
+                self.loop.remove_reader(self.outbox.fileno())
+                return False
+            self.queue.dropped.update(batch.dropped)
+            self.callback(batch)
+        return True
+
+    def put_nowait(self, data):
+        ''' Called by the ctd.PipelineCTDInterface with the data received. '''
+        self.inbox.send(('data', (time.time(), bytes(data))))
+
+    def reset(self):
+        ''' Resets the running averagers, in order with the data received. '''
+        self.inbox.send(('reset', None))
+
+    def set_averagers(self, averagers):
+        ''' Sets the state (k, xp) of the running averagers. '''
+        self.inbox.send(('averagers', averagers))
+
+    def set_profiling(self, on):
+        ''' Starts (on True) or stops profiling of the worker process. '''
+        self.inbox.send(('profile', on))
+
+    def stop(self):
+        self.inbox.send(('stop', None))
+        # the last batches are received until the worker exits.
+        t_end = time.time() + 5
+        while self.receive(timeout=0.1) and time.time() < t_end:
+            pass
+        self.loop.remove_reader(self.outbox.fileno())
+        self.process.join(5)
@@ -0,0 +1,79 @@
+import cProfile
+import os
+import time
+import tracemalloc
+
+# Profiling hooks, to be switched on and off while the program runs (key F),
+# or from the start by setting the environment variable CTDSAMPLER_PROFILE
+# (or the option --profile). The environment is inherited by the plot
+# process, which profiles itself likewise. When profiling is off, nothing
+# is installed, so there is no overhead.
+#
+# Each run writes ctdsampler_<tag>_<time>.prof (read with pstats or
+# snakeviz) and, for processes tracing memory, ctdsampler_<tag>_<time>.tracemalloc
+# (read with tracemalloc.Snapshot.load).
+
+ENVIRONMENT_VARIABLE = 'CTDSAMPLER_PROFILE'
+
+
+def is_enabled_by_environment():
+    return os.environ.get(ENVIRONMENT_VARIABLE, '') not in ('', '0')
+
+
+class Profiler(object):
+    ''' cProfile and tracemalloc, togglable at runtime.
+
+        cProfile profiles the thread in which start() is called (from
+        Python 3.12 on, the whole process, and a second profiler in the same
+        process cannot be started). tracemalloc traces the whole process, so
+        only one profiler per process should have trace_memory set.
+    '''
+    def __init__(self, tag='main', trace_memory=True, directory='.'):
+        self.tag = tag
+        self.trace_memory = trace_memory
+        self.directory = directory
+        self.profile = None
+
+    @property
+    def is_running(self):
+        return not self.profile is None
+
+    def start(self):
+        ''' Starts profiling.
+
+        Returns:
+        --------
+        False if another profiler is active in this process, else True.
+        '''
+        self.started = time.strftime('%y%m%dT%H%M%S')
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return False
+        self.profile = profile
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return True
+
+    def stop(self):
+        ''' Stops profiling and writes the results.
+
+        Returns:
+        --------
+        the base name of the files written.
+        '''
+        self.profile.disable()
+        fn = os.path.join(self.directory, f"ctdsampler_{self.tag}_{self.started}")
+        self.profile.dump_stats(f"{fn}.prof")
+        self.profile = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.take_snapshot().dump(f"{fn}.tracemalloc")
+            tracemalloc.stop()
+        return fn
+
+    def toggle(self):
+        if self.is_running:
+            self.stop()
+        else:
+            self.start()
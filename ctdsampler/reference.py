@@ -0,0 +1,290 @@
+import asyncio
+from datetime import datetime
+import os
+import time
+
+import numpy as np
+import serial_asyncio
+
+from . import ctd
+
+# Ingestion of a reference instrument (thermometer/salinometer in the
+# calibration bath), as an alternative to typing the bath values in by hand
+# (calibration.KeyboardInput). The reference values and the CTD samples are
+# aligned onto a common time grid, and each time the bath has been stable
+# for a while, a calibration point (reference values, instrument values) is
+# written to file, in the format read by calibration.ConductivityCalibration.
+
+CHANNELS = 'c t d dt P T'.split()
+
+
+class Aligner(object):
+    ''' Incremental alignment of a reference stream and the CTD samples onto
+        a common time grid, by linear interpolation.
+
+        Data are added as they arrive. align() interpolates, in one go, the
+        grid points up to the latest time covered by both streams, and
+        discards the data that are no longer needed. Hours of data are
+        therefore never aligned again.
+
+        Grid points in a gap of either stream (while logging was stopped,
+        for instance) are skipped, as interpolating across it would make
+        up values.
+    '''
+    def __init__(self, interval=1., max_gap=10.):
+        ''' Constructor
+
+        Params:
+        -------
+        interval: spacing of the time grid in seconds
+        max_gap: maximum time (s) between the data of a stream on either
+                 side of a grid point
+        '''
+        self.interval = interval
+        self.max_gap = max_gap
+        self.reference = [np.empty(0), None]
+        self.samples = [np.empty(0), None]
+        self.pending_reference = []
+        self.pending_samples = []
+        self.t_next = None
+
+    def add_reference(self, t, values):
+        self.pending_reference.append((t, *values))
+
+    def add_sample(self, t, sample):
+        ''' Adds a CTD sample (c, t, d, dt, P, T). dt is None for converted output. '''
+        self.pending_samples.append((t, *[np.nan if v is None else v for v in sample]))
+
+    def add_rows(self, rows):
+        ''' Adds CTD samples as rows (t, c, t, d, dt, P, T), dt NaN for
+            converted output (see archive.to_row()).
+        '''
+        self.pending_samples.extend(np.asarray(rows, dtype=float).tolist())
+
+    def _extend(self, stream, pending):
+        if pending:
+            data = np.array(pending, dtype=float)
+            pending.clear()
+            if stream[1] is None:
+                stream[0], stream[1] = data[:,0], data[:,1:]
+            else:
+                stream[0] = np.hstack([stream[0], data[:,0]])
+                stream[1] = np.vstack([stream[1], data[:,1:]])
+
+    def _trim(self, stream, t):
+        # keep the last point before t, needed to interpolate at t.
+        i = max(np.searchsorted(stream[0], t, side='right') - 1, 0)
+        stream[0], stream[1] = stream[0][i:], stream[1][i:]
+
+    def covered(self, grid, t):
+        ''' Returns which grid points have data of a stream (times t) within
+            max_gap around them.
+        '''
+        i = np.searchsorted(t, grid, side='right')
+        before = t[np.maximum(i - 1, 0)]
+        after = t[np.minimum(i, t.shape[0] - 1)]
+        return after - before <= self.max_gap
+
+    def align(self):
+        ''' Aligns the data received since the previous call.
+
+        Returns:
+        --------
+        times, reference values and CTD samples at the new grid points
+        (arrays of length 0 if there are none). Grid points in a gap are
+        left out.
+        '''
+        self._extend(self.reference, self.pending_reference)
+        self._extend(self.samples, self.pending_samples)
+        t_ref, ref = self.reference
+        t_ctd, ctd_values = self.samples
+        if ref is None or ctd_values is None or not t_ref.shape[0] or not t_ctd.shape[0]:
+            return np.empty(0), np.empty((0, 0)), np.empty((0, len(CHANNELS)))
+        if self.t_next is None:
+            t0 = max(t_ref[0], t_ctd[0])
+            self.t_next = np.ceil(t0/self.interval)*self.interval
+        t_end = min(t_ref[-1], t_ctd[-1])
+        n = int(np.floor((t_end - self.t_next)/self.interval)) + 1
+        if n <= 0:
+            return np.empty(0), np.empty((0, ref.shape[1])), np.empty((0, len(CHANNELS)))
+        grid = self.t_next + np.arange(n)*self.interval
+        self.t_next = grid[-1] + self.interval
+        grid = grid[self.covered(grid, t_ref) & self.covered(grid, t_ctd)]
+        ref_grid = np.vstack([np.interp(grid, t_ref, v) for v in ref.T]).T
+        ctd_grid = np.vstack([np.interp(grid, t_ctd, v) for v in ctd_values.T]).T
+        self._trim(self.reference, self.t_next)
+        self._trim(self.samples, self.t_next)
+        return grid, ref_grid, ctd_grid
+
+
+class PlateauDetector(object):
+    ''' Detects periods of stable reference values in the aligned data, and
+        returns their averages as calibration points. A window does not
+        span a gap in the grid.
+    '''
+    def __init__(self, window=60, tolerances=(0.002, 0.0005), interval=1.):
+        ''' Constructor
+
+        Params:
+        -------
+        window: number of grid points the reference has to be stable
+        tolerances: maximum standard deviation of each reference value
+                    within the window.
+        interval: spacing of the time grid in seconds
+        '''
+        self.window = window
+        self.tolerances = np.array(tolerances)
+        self.interval = interval
+        self.t = np.empty(0)
+        self.ref = np.empty((0, len(tolerances)))
+        self.ctd = np.empty((0, len(CHANNELS)))
+
+    def add(self, t, ref, ctd_values):
+        ''' Adds aligned data at grid times t.
+
+        Returns:
+        --------
+        list of (reference values, CTD values) averaged over each stable window.
+        '''
+        self.t = np.hstack([self.t, t])
+        self.ref = np.vstack([self.ref, ref])
+        self.ctd = np.vstack([self.ctd, ctd_values])
+        points = []
+        while self.ref.shape[0] >= self.window:
+            ref = self.ref[:self.window]
+            gaps = np.flatnonzero(np.diff(self.t[:self.window]) > 1.5*self.interval)
+            if gaps.shape[0]:
+                # start again after the last gap in the window.
+                i = gaps[-1] + 1
+            elif np.all(ref.std(axis=0) < self.tolerances):
+                points.append((ref.mean(axis=0), self.ctd[:self.window].mean(axis=0)))
+                i = self.window
+            else:
+                i = 1
+            self.t = self.t[i:]
+            self.ref = self.ref[i:]
+            self.ctd = self.ctd[i:]
+        return points
+
+
+class ReferenceRecorder(object):
+    ''' Collects reference values and CTD samples, and writes calibration
+        points (bath_temp bath_cond inst_freq) to file. The CTD has to be
+        set to raw output, in which c is the conductivity frequency (Hz).
+    '''
+    def __init__(self, loop, filename=None, interval=1., window=60,
+                 tolerances=(0.002, 0.0005), max_gap=10.):
+        self.loop = loop
+        if filename is None:
+            filename = f"ctd_calibration_{time.strftime('%y%m%dT%H%M')}.txt"
+        self.filename = filename
+        self.aligner = Aligner(interval, max_gap)
+        self.detector = PlateauDetector(window, tolerances, interval)
+        self.n_points = 0
+        self.handle = None
+
+    def start(self):
+        if not os.path.exists(self.filename):
+            with open(self.filename, 'w') as fp:
+                fp.write("# bath_temp bath_cond inst_freq\n")
+                fp.write("# degree C  S/m       Hz\n")
+                fp.write("#\n")
+        self.handle = self.loop.call_later(self.aligner.interval, self.update)
+
+    def close(self):
+        if self.handle:
+            self.handle.cancel()
+
+    def add_reference(self, t, values):
+        self.aligner.add_reference(t, values)
+
+    def add_sample(self, t, sample):
+        self.aligner.add_sample(t, sample)
+
+    def add_rows(self, rows):
+        self.aligner.add_rows(rows)
+
+    def update(self):
+        t, ref, ctd_values = self.aligner.align()
+        if ref.shape[0]:
+            points = self.detector.add(t, ref, ctd_values)
+            self.save_points(points)
+        self.handle = self.loop.call_later(self.aligner.interval, self.update)
+
+    def save_points(self, points):
+        with open(self.filename, 'a') as fp:
+            for ref, ctd_values in points:
+                c, dt = ctd_values[CHANNELS.index('c')], ctd_values[CHANNELS.index('dt')]
+                if np.isnan(dt):
+                    # converted output, c is not a frequency.
+                    continue
+                bath_temp, bath_cond = ref[:2]
+                fp.write(f"{bath_temp} {bath_cond} {c}\n")
+                self.n_points+=1
+
+
+def parse_reference(s):
+    ''' Parses a line of a reference instrument: white space or comma
+        separated values, bath_temp first, bath_cond second.
+    '''
+    return [float(x) for x in s.replace(",", " ").split()]
+
+
+class ReferenceInterface(asyncio.Protocol):
+    ''' Serial interface to a reference instrument. Lines are time-stamped
+        on arrival and passed to the recorder.
+    '''
+    def __init__(self, *p, **k):
+        super().__init__(*p, **k)
+        self.framer = ctd.LineFramer()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        t = time.time()
+        for s in self.framer.feed(ctd.decode(data)):
+            try:
+                values = parse_reference(s)
+            except ValueError:
+                continue
+            if len(values) >= 2:
+                self.recorder.add_reference(t, values[:2])
+
+
+async def start_reference_interface(loop, recorder, device, baudrate):
+    transport, protocol = await serial_asyncio.create_serial_connection(loop, ReferenceInterface,
+                                                                        device, baudrate)
+    protocol.recorder = recorder
+    return protocol
+
+
+def parse_time(s):
+    ''' Parses a time stamp: seconds since 1970 or an ISO 8601 string. '''
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.fromisoformat(s.strip()).timestamp()
+
+
+async def tail_csv(filename, recorder, poll_interval=0.5):
+    ''' Follows a CSV file written by a reference instrument, with lines
+        time_stamp, bath_temp, bath_cond. Only lines appended after the
+        start are read.
+    '''
+    with open(filename, 'r') as fp:
+        fp.seek(0, os.SEEK_END)
+        buf = ''
+        while True:
+            buf += fp.read()
+            *lines, buf = buf.split('\n')
+            for s in lines:
+                fields = s.split(',')
+                try:
+                    t = parse_time(fields[0])
+                    values = [float(x) for x in fields[1:3]]
+                except ValueError:
+                    continue
+                if len(values) == 2:
+                    recorder.add_reference(t, values)
+            await asyncio.sleep(poll_interval)
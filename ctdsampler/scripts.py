@@ -13,12 +13,36 @@ import asyncio
 
     
 import asyncio
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import os
+from argparse import ArgumentParser, ArgumentTypeError, RawDescriptionHelpFormatter
 import multiprocessing as mp
 
 from . import ctd
 from . import ui as ctdsampler_ui
 from . import graphs
+from . import broadcast
+from . import pipeline
+from . import reference
+from . import archive
+from . import snapshot
+from . import profiling
+
+
+def positive_int(s):
+    ''' Argument type of integers of at least 1. '''
+    n = int(s)
+    if n < 1:
+        raise ArgumentTypeError(f"must be at least 1, not {n}")
+    return n
+
+
+def positive_float(s):
+    ''' Argument type of finite numbers greater than 0. '''
+    x = float(s)
+    if not (0 < x < float('inf')):
+        raise ArgumentTypeError(f"must be a number greater than 0, not {s}")
+    return x
+
 
 def main():
     mp.set_start_method('spawn')
@@ -60,6 +84,22 @@ def main():
     The Results field shows the running averaged values of the data
     read.
 
+    Both fields are redrawn at a fixed rate (see --refresh_rate),
+    irrespective of the rate at which data arrive. The title of the
+    Results field shows how many updates were coalesced.
+
+    At most --queue_size samples are kept waiting to be processed. If
+    the program cannot keep up, samples are dropped according to
+    --overload_policy: drop-oldest, drop-newest or coalesce (the newest
+    waiting sample is dropped in favour of the latest one). The number of dropped
+    samples is shown in the Results title. Other output of the CTD, such
+    as the calibration parameters saved to file, is never dropped.
+
+    With the option --pipeline, the data are framed, parsed and averaged
+    in a worker process, and the results are handed to the user interface
+    in batches. The key-to-command latency of both modes can be measured
+    with benchmarks/key_latency.py.
+
     When the program is started, also a graphic window pops-up,
     showing the data recorded graphically. Measurements (values
     presented in Monitor) are indicated by a dot, whereas the running
@@ -67,6 +107,82 @@ def main():
     Depending on the output format (raw/converted), four or three
     panels are populated with data.
 
+    On slow computers, or when working remotely, the option
+    --backend terminal shows the data as sparklines in the terminal
+    instead, below the Results field.
+
+    Calibration
+    -----------
+    With the option --reference, the values of a reference instrument in
+    the calibration bath (bath temperature and conductivity) are read
+    from a serial device, or from a CSV file (time stamp, bath_temp,
+    bath_cond) that is being written by another program. The reference
+    values and the CTD samples are aligned in time, by the time they
+    arrived. Periods in which either is missing for more than 10 s (as
+    while logging is stopped) are left out. Each time the bath
+    has been stable for a minute, a calibration point is written to the
+    file ctd_calibration_<date>.txt, which can be read by
+    calibration.ConductivityCalibration. The CTD should be set to raw
+    output.
+
+    In the residual plot of a calibration (graph()), clicking a point
+    excludes it from the fit, or includes it again. The fit, the plot
+    and the report are updated immediately. A point is not excluded if
+    fewer points than coefficients would remain. Outliers can also be
+    downweighted automatically with calibrate(loss='huber') or
+    calibrate(loss='tukey'); tukey rejects them entirely.
+
+    With calibrate(free=('CTcor',)), CTcor (and/or WBOTC) is fitted as
+    well. calibration.compare_models() fits these model variants and
+    calibration.report_models() ranks them by AIC and BIC, to show
+    whether fitting the extra parameters is justified.
+
+    Certificates for any number of fitted conductivity calibrations are
+    written by
+
+        from ctdsampler import certificates
+        certificates.generate_certificates([comet, dipsy], ['comet', 'dipsy'])
+
+    which writes, per instrument, a page with the coefficients, the
+    calibration points and residuals and the residual plot (PDF and
+    SVG), and a JSON file with the same data and the model evaluated
+    over a grid of temperature and instrument frequency.
+
+    Broadcasting
+    ------------
+    With the option --serve, the samples are broadcast to other local
+    programs, on a unix domain socket (--serve /tmp/ctd.sock) or on a
+    TCP port on localhost (--serve 5555). Subscribers receive batches of
+    samples as binary frames (see ctdsampler/broadcast.py). In Python:
+
+        from ctdsampler import broadcast
+        for sequence_number, samples in broadcast.subscribe('/tmp/ctd.sock'):
+            print(samples)
+
+    A subscriber that does not keep up loses the oldest frames, but
+    never slows down the acquisition.
+
+    Archive
+    -------
+    With the option --archive FILE, the samples are recorded in a
+    compressed archive, in chunks that carry their time range and the
+    min, max and mean of each channel. All samples received are
+    recorded, also those dropped by the overload policy. Samples that
+    do not fill a chunk yet are saved every 10 s. If FILE exists, the
+    session is appended to it. The CTD configuration saved
+    with key P, and the calibration points of --reference, are stored
+    in the archive as well. Reading a few minutes of a long session
+    only decompresses the chunks concerned:
+
+        from ctdsampler import archive
+        with archive.Archive('session.ctda') as a:
+            t, c = a.query('c', t0, t1)
+            a.overview()   # from the chunk summaries only
+
+    archive.metadata_to_configuration() and
+    archive.metadata_to_calibration() write the metadata back as
+    text files.
+
     Commands
     
     Note: The key commands to the program work only if the terminal
@@ -88,45 +204,123 @@ def main():
     | Adjust y-scales        : press A to adjust the y-scales of all graphs|
     |                          to the data extent.                         |
     |                                                                      |
+    | Profiling              : press F to start/stop profiling. Profiles   |
+    |                          and memory snapshots of the program, the    |
+    |                          worker process (--pipeline) and the graph   |
+    |                          process are written to files                |
+    |                          ctdsampler_<process>_<time>.prof and        |
+    |                          .tracemalloc. Use --profile to profile from |
+    |                          the start.                                  |
+    |                                                                      |
     | End program            : press Q                                     |
     +----------------------------------------------------------------------+
 
     
-    Bugs
-    ----
-    Closing the graphical window causes the program to exit uncleanly.
+    Resuming a session
+    ------------------
+    The running averages, the data in the graph, the output format and
+    the last calibration parameter dump are saved every second to the
+    file ctdsampler_session.snapshot (option --snapshot). After the
+    program was ended, or crashed, the option --resume restores them,
+    so that the averages need not settle again. Without --resume, the
+    previous snapshot is kept until the first sample arrives, and then
+    renamed to ctdsampler_session.snapshot.prev.
+
+    If the graphical window is closed, it is opened again, with the
+    data received in the meantime. Acquisition is not interrupted.
+    If the window cannot be shown (the plot process ends within a
+    few seconds), it is tried again at growing intervals, and after
+    three attempts the status shows "plot window: gave up".
 
     '''
     parser = ArgumentParser(description=desc,
                             formatter_class=RawDescriptionHelpFormatter)
     parser.add_argument("-d", "--device", dest="device", default='/dev/ttyUSB0', metavar="SERIAL_DEVICE", help="Path to serial device")
     parser.add_argument("-N", "--data_buffer_size", dest="data_buffer_size", default=100, type=int)
+    parser.add_argument("--queue_size", dest="queue_size", default=1000, type=positive_int, help="Maximum number of samples waiting to be processed")
+    parser.add_argument("--overload_policy", dest="overload_policy", default='drop-oldest', choices=ctd.OVERLOAD_POLICIES, help="Samples to drop when the queue is full")
+    parser.add_argument("-b", "--backend", dest="backend", default='matplotlib', choices=['matplotlib', 'terminal'], help="Plot in a graphic window (matplotlib) or as sparklines in the terminal")
+    parser.add_argument("--serve", dest="serve", default=None, metavar="ADDRESS", help="Broadcast the samples to local subscribers on a unix domain socket (path) or TCP port on localhost (port or localhost:port)")
+    parser.add_argument("--reference", dest="reference", default=None, metavar="SOURCE", help="Serial device or CSV file of a reference instrument, for automatic calibration points")
+    parser.add_argument("--reference_baudrate", dest="reference_baudrate", default=9600, type=int)
+    parser.add_argument("-a", "--archive", dest="archive", default=None, metavar="FILE", help="Record the samples in a compressed, time-indexed archive")
+    parser.add_argument("--snapshot", dest="snapshot", default='ctdsampler_session.snapshot', metavar="FILE", help="File to which the session state is saved every second")
+    parser.add_argument("--resume", dest="resume", action='store_true', help="Resume the session saved in the snapshot file")
+    parser.add_argument("-p", "--pipeline", dest="pipeline", action='store_true', help="Parse the data in a worker process, keeping the user interface responsive under load")
+    parser.add_argument("--profile", dest="profile", action='store_true', help=f"Profile from the start (as setting {profiling.ENVIRONMENT_VARIABLE}=1)")
+    parser.add_argument("-r", "--refresh_rate", dest="refresh_rate", default=15, type=positive_float, metavar="HZ", help="Screen refresh rate of the Monitor and Results fields")
     
     options = parser.parse_args()
+    if options.profile:
+        # set in the environment, so that the plot process inherits it.
+        os.environ[profiling.ENVIRONMENT_VARIABLE] = '1'
 
     device = options.device
     baudrate = 9600
     # get the event loop and queue to pass data from ctd_interface to ui
     loop = asyncio.get_event_loop()
-    queue = asyncio.Queue()
+    queue = ctd.SampleQueue(options.queue_size, options.overload_policy)
 
 
-    # and the ctd_interface (serial connection to the CTD itself)
-    ctd_interface = loop.run_until_complete(ctd.start_serial_interface(loop, queue,
-                                                                       ctd.CTDInterface,
-                                                                       device, baudrate))
-        
     # create the user interface.
-    ui = ctdsampler_ui.UI(loop, queue)
+    ui = ctdsampler_ui.UI(loop, queue, options.refresh_rate)
+    # the graph is created first, as the terminal backend adds a widget to the ui.
+    ui.graph = graphs.Graph(options.data_buffer_size, options.backend)
+    # the archive and the reference recorder are set up before any data
+    # are received.
+    if options.archive:
+        try:
+            ui.archive = archive.ArchiveWriter(options.archive, loop)
+        except ValueError as e:
+            parser.error(str(e))
+    if options.reference:
+        ui.reference = reference.ReferenceRecorder(loop)
+        ui.reference.start()
+
+    if options.pipeline:
+        # framing and parsing are done by a worker process
+        ui.worker = pipeline.ParserWorker(loop, queue, ui.apply_batch, ui.sizes['top'],
+                                          ui.sizes['body'], options.data_buffer_size,
+                                          collect_samples=bool(options.serve),
+                                          record_samples=bool(options.archive or options.reference))
+        ui.worker.start()
+        interface, receiver = ctd.PipelineCTDInterface, ui.worker
+    else:
+        interface, receiver = ctd.CTDInterface, queue
+
+    # and the ctd_interface (serial connection to the CTD itself)
+    ctd_interface = loop.run_until_complete(ctd.start_serial_interface(loop, receiver,
+                                                                       interface,
+                                                                       device, baudrate,
+                                                                       ui.archive, ui.reference))
     # connect ctd_interface.writer to ui.writer
     ui.writer = ctd_interface.writer
     # 
     urwid_loop = ui.build_app()
+    if options.resume and os.path.exists(options.snapshot):
+        state = snapshot.load(options.snapshot)
+        if state:
+            snapshot.restore(ui, state)
+    ui.snapshot = snapshot.SnapshotWriter(loop, ui, options.snapshot)
+    ui.snapshot.start()
+    if profiling.is_enabled_by_environment():
+        ui.profiler.start()
 
-    ui.graph = graphs.Graph(options.data_buffer_size)
+    if options.serve:
+        ui.server = broadcast.SampleServer(loop, options.serve)
+        loop.run_until_complete(ui.server.start())
     # create tasks that are run asynchronously:
     tasks ={}
-    tasks['input'] = loop.create_task(ui.parse_input())
+    if not ui.worker:
+        tasks['input'] = loop.create_task(ui.parse_input())
+
+    if options.reference:
+        if os.path.isfile(options.reference):
+            tasks['reference'] = loop.create_task(reference.tail_csv(options.reference, ui.reference))
+        else:
+            loop.run_until_complete(reference.start_reference_interface(loop, ui.reference,
+                                                                        options.reference,
+                                                                        options.reference_baudrate))
 
     try:
         urwid_loop.run()
@@ -139,5 +333,18 @@ def main():
     for k, v in tasks.items():
         v.cancel()
     urwid_loop.stop()
+    if ui.profiler.is_running:
+        ui.profiler.stop()
+    if ui.worker:
+        ui.worker.stop()
+    if ui.server:
+        ui.server.close()
+    if ui.reference:
+        ui.reference.close()
+    ui.snapshot.close()
+    if ui.archive:
+        if ui.reference and os.path.exists(ui.reference.filename):
+            ui.archive.add_calibration('reference', ui.reference.filename)
+        ui.archive.close()
     #plt.close('all') # Who creates the figure???
     return 0
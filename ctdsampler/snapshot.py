@@ -0,0 +1,187 @@
+import os
+import pickle
+import struct
+import zlib
+
+# Session snapshots, from which a session is resumed (option --resume) after
+# the program was ended, or ended uncleanly. A snapshot holds:
+#
+#   averagers  : the state (k, xp) of the running averagers
+#   lines,
+#   points     : the data kept by the graph (averages and measurements)
+#   israwoutput: the output mode of the CTD
+#   dump       : the lines of the last calibration parameter dump (dc)
+#
+# The snapshot file is a journal of records: a full snapshot, followed by
+# incremental ones, holding the lines and points plotted since the previous
+# record, and the other fields only if they changed. Every record is framed
+# by its length and a CRC, so that a record that was written partly is
+# ignored. After compact_every records, the journal is replaced by a single
+# full snapshot (written to a temporary file, which is then renamed).
+#
+# The snapshot file of the previous session is left alone until the new
+# session has data to save (a sample, or a restored state). It is then
+# renamed to <snapshot file>.prev, so that starting the program without
+# --resume by mistake does not lose a session.
+
+RECORD = struct.Struct('<II')
+
+
+def encode_record(state):
+    body = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    return RECORD.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(filename):
+    ''' Reads the records of a snapshot file, up to the first one that is
+        incomplete or corrupt.
+    '''
+    records = []
+    with open(filename, 'rb') as fp:
+        b = fp.read()
+    offset = 0
+    while offset + RECORD.size <= len(b):
+        n, crc = RECORD.unpack_from(b, offset)
+        body = b[offset + RECORD.size:offset + RECORD.size + n]
+        if len(body) != n or zlib.crc32(body) != crc:
+            break
+        records.append(pickle.loads(body))
+        offset += RECORD.size + n
+    return records
+
+
+def load(filename, N=None):
+    ''' Reads a snapshot file and merges its records
+
+    Params:
+    -------
+    filename: snapshot file
+    N: number of lines and points to keep, default all.
+
+    Returns:
+    --------
+    dictionary with the state, or None if the file holds no full snapshot.
+    '''
+    state = None
+    for record in read_records(filename):
+        if record.pop('full'):
+            state = record
+        elif not state is None:
+            lines, points = record.pop('lines'), record.pop('points')
+            state['lines'].extend(lines)
+            state['points'].extend(points)
+            state.update(record)
+        if not state is None and not N is None:
+            state['lines'] = state['lines'][-N:]
+            state['points'] = state['points'][-N:]
+    return state
+
+
+def get_state(ui):
+    ''' Returns the state of the session, other than the graph data. '''
+    return dict(averagers=dict((k, (ra.k, ra.xp)) for k, ra in ui.ra.items()),
+                israwoutput=ui.israwoutput, dump=ui.dump)
+
+
+def has_data(ui):
+    ''' Returns True if the session has a state worth saving. '''
+    return (any(ra.k for ra in ui.ra.values()) or bool(ui.dump)
+            or bool(ui.graph.lines) or bool(ui.graph.points))
+
+
+def restore(ui, state):
+    ''' Restores the state of the session, as returned by load(). '''
+    for k, (n, xp) in state['averagers'].items():
+        ui.ra[k].k = n
+        ui.ra[k].xp = xp
+    if ui.worker:
+        # the averagers are run by the worker process (pipeline mode).
+        ui.worker.set_averagers(state['averagers'])
+    ui.israwoutput = state['israwoutput']
+    label_type = None
+    if state['lines']:
+        label_type = 'raw' if state['israwoutput'] else 'converted'
+    ui.graph.restore(state['lines'], state['points'], label_type)
+    if state['dump']:
+        ui.dump = state['dump']
+        ui.show_dump(state['dump'])
+
+
+class SnapshotWriter(object):
+    ''' Writes snapshots of the session every interval seconds. '''
+    def __init__(self, loop, ui, filename='ctdsampler_session.snapshot', interval=1.,
+                 compact_every=300):
+        ''' Constructor
+
+        Params:
+        -------
+        loop: asyncio event loop
+        ui: ui.UI
+        filename: snapshot file
+        interval: time between snapshots (s)
+        compact_every: number of incremental snapshots after which the
+                       file is rewritten with a full snapshot.
+        '''
+        self.loop = loop
+        self.ui = ui
+        self.filename = filename
+        self.interval = interval
+        self.compact_every = compact_every
+        self.fp = None
+        self.handle = None
+
+    def start(self):
+        self.handle = self.loop.call_later(self.interval, self.update)
+
+    def close(self):
+        if self.handle:
+            self.handle.cancel()
+        self.update(reschedule=False)
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+    def write_full(self):
+        ''' Replaces the snapshot file with a full snapshot. '''
+        self.state = get_state(self.ui)
+        lines, points, self.counts = self.ui.graph.get_data()
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, 'wb') as fp:
+            fp.write(encode_record(dict(self.state, lines=lines, points=points, full=True)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.filename)
+        if self.fp:
+            self.fp.close()
+        self.fp = open(self.filename, 'ab')
+        self.n_records = 0
+
+    def update(self, reschedule=True):
+        ''' Writes an incremental snapshot, or a full one every compact_every
+            snapshots, or if the graph was cleared. The first snapshot is
+            written once the session has data.
+        '''
+        if self.fp is None:
+            if has_data(self.ui):
+                if os.path.exists(self.filename):
+                    os.replace(self.filename, f"{self.filename}.prev")
+                self.write_full()
+        elif self.n_records >= self.compact_every or self.ui.graph.n_clears != self.counts[2]:
+            self.write_full()
+        else:
+            self.write_incremental()
+        if reschedule:
+            self.handle = self.loop.call_later(self.interval, self.update)
+
+    def write_incremental(self):
+        lines, points, self.counts = self.ui.graph.get_data(since=self.counts)
+        record = dict(full=False, lines=lines, points=points)
+        state = get_state(self.ui)
+        for k, v in state.items():
+            if v != self.state[k]:
+                record[k] = self.state[k] = v
+        if len(record) == 3 and not lines and not points:
+            return
+        self.fp.write(encode_record(record))
+        self.fp.flush()
+        self.n_records+=1
@@ -0,0 +1,199 @@
+from collections import deque
+
+import numpy as np
+import urwid
+
+from .graphs import PlotBackend
+
+# Lightweight plot backend, drawing the six channels as braille sparklines
+# in the terminal. Each character cell holds 2x4 dots, so that a sparkline
+# of width w and height h shows 2w data points at a vertical resolution of
+# 4h dots.
+
+BRAILLE_OFFSET = 0x2800
+# bit of the braille dot at (column, row) within a character cell
+DOT_BITS = np.array([[0x01, 0x02, 0x04, 0x40],
+                     [0x08, 0x10, 0x20, 0x80]])
+
+CHANNELS = 'c t d dt P T'.split()
+
+
+def braille(series, width, height, limits):
+    ''' Draws a series as braille dots
+
+    Parameters:
+    ----------
+    series: sequence of values (NaNs are skipped)
+    width: number of character columns
+    height: number of character rows
+    limits: (ymin, ymax). Values outside are drawn at the edges.
+
+    Returns:
+    --------
+    array of size (height x width) with the dot bits of each character cell
+    '''
+    cells = np.zeros((height, width), dtype=int)
+    y = np.asarray(series, dtype=float)[-2*width:]
+    x = np.arange(y.shape[0])
+    i = np.isfinite(y)
+    x, y = x[i], y[i]
+    if not y.shape[0]:
+        return cells
+    ymin, ymax = limits
+    scale = (ymax - ymin) or 1.
+    ndots = 4*height
+    row = np.round((ymax - y)/scale*(ndots-1)).astype(int).clip(0, ndots-1)
+    np.bitwise_or.at(cells, (row//4, x//2), DOT_BITS[x%2, row%4])
+    return cells
+
+
+def to_text(cells):
+    ''' Converts an array of dot bits to a string of braille characters. '''
+    return "\n".join("".join(chr(BRAILLE_OFFSET + i) for i in row) for row in cells)
+
+
+class Sparkline(urwid.Widget):
+    ''' urwid widget drawing an averaged series and a series of
+        measurements as braille dots, adapting to the available width.
+        The label is drawn in a column of fixed width to the left (which is
+        much cheaper than using urwid.Columns).
+    '''
+    _sizing = frozenset(['flow'])
+
+    def __init__(self, lines, points, height=2, label_width=24):
+        super().__init__()
+        self.lines = lines
+        self.points = points
+        self.height = height
+        self.label_width = label_width
+        self.label = [""]*height
+        self.limits = None
+
+    def set_label(self, label):
+        ''' Sets the label, one string per row. '''
+        self.label = label
+        self._invalidate()
+
+    def rows(self, size, focus=False):
+        return self.height
+
+    def adjust_limits(self):
+        ''' Sets the y-limits to the data extent. '''
+        y = np.array(list(self.lines) + list(self.points), dtype=float)
+        y = y[np.isfinite(y)]
+        if y.shape[0]:
+            self.limits = y.min(), y.max()
+        else:
+            self.limits = None
+
+    def text_rows(self, maxcol):
+        ''' Returns the rows of text drawing the sparkline in maxcol columns. '''
+        width = max(maxcol - self.label_width - 1, 0)
+        if self.limits is None:
+            self.adjust_limits()
+        cells = np.zeros((self.height, width), dtype=int)
+        if self.limits is not None:
+            for _series in (self.lines, self.points):
+                cells |= braille(_series, width, self.height, self.limits)
+        label = self.label
+        if self.height < len(label):
+            # label and value on one row
+            label = [label[0] + label[-1].strip().rjust(self.label_width - len(label[0]))]
+        label = label + [""]*(self.height - len(label))
+        return [f"{_label[:self.label_width]:{self.label_width}} {row}"
+                for _label, row in zip(label, to_text(cells).split("\n"))]
+
+    def render(self, size, focus=False):
+        (maxcol,) = size
+        return urwid.Text("\n".join(self.text_rows(maxcol)), wrap='clip').render((maxcol,))
+
+
+class SparklineStack(urwid.Widget):
+    ''' Box widget stacking sparklines, with the rows available shared
+        among them. If there are fewer rows than sparklines, the first
+        ones are shown.
+    '''
+    _sizing = frozenset(['box'])
+
+    def __init__(self, sparklines):
+        super().__init__()
+        self.sparklines = sparklines
+
+    def render(self, size, focus=False):
+        maxcol, maxrow = size
+        height = max(maxrow//len(self.sparklines), 1)
+        rows = []
+        for sparkline in self.sparklines[:maxrow]:
+            sparkline.height = height
+            rows.extend(sparkline.text_rows(maxcol))
+        rows = rows + [""]*(maxrow - len(rows))
+        return urwid.Text("\n".join(rows), wrap='clip').render((maxcol,))
+
+
+class TerminalBackend(PlotBackend):
+    ''' Plot backend showing sparklines of all channels in the user interface.
+
+        Measurements and running averages are drawn as dots in the same
+        sparkline, the label column shows the latest running average. As
+        with the matplotlib backend, the y-scales are set to the data
+        extent when the first data arrive, and when adjust_axes() is
+        called.
+    '''
+    label_width = 24
+
+    def __init__(self, N=100, labels=None):
+        self.labels = labels
+        self.label_type = 'converted'
+        self.data = dict((k, deque(maxlen=N)) for k in CHANNELS)
+        self.data_points = dict((k, deque(maxlen=N)) for k in CHANNELS)
+        self.sparklines = dict((k, Sparkline(self.data[k], self.data_points[k],
+                                             label_width=self.label_width))
+                               for k in CHANNELS)
+        self.stack = SparklineStack([self.sparklines[k] for k in CHANNELS])
+        self.widget = urwid.LineBox(self.stack, title=u'Graph')
+        self.dirty = True
+
+    def append(self, data, p):
+        if len(p)==6:
+            c, t, d, dt, P, T = p
+        else:
+            c, t, d, P, T = p
+            dt = None
+        for k, v in zip(CHANNELS, (c, t, d, dt, P, T)):
+            if not v is None:
+                data[k].append(v)
+        self.dirty = True
+
+    def plot(self, *p):
+        self.append(self.data, p)
+
+    def plot_points(self, *p):
+        self.append(self.data_points, p)
+
+    def clear(self):
+        for k in CHANNELS:
+            self.data[k].clear()
+            self.data_points[k].clear()
+        self.dirty = True
+
+    def adjust_axes(self):
+        for sparkline in self.sparklines.values():
+            sparkline.adjust_limits()
+        self.dirty = True
+
+    def set_labels(self, label_type):
+        self.label_type = label_type
+        self.dirty = True
+
+    def render(self):
+        if not self.dirty:
+            return
+        for k, label in zip(CHANNELS, self.labels[self.label_type]):
+            latest = self.data[k][-1] if self.data[k] else None
+            if latest is None:
+                value = ""
+            else:
+                value = "{:10.5f}".format(latest)
+            self.sparklines[k].set_label([label, f"{value:>{self.label_width}}"])
+        self.stack._invalidate()
+        self.dirty = False
@@ -1,11 +1,13 @@
 import asyncio
-from collections import deque
+from collections import deque, namedtuple
 import urwid
 import time
 
+from . import ctd
 from . import graphs
+from . import profiling
 
-_, QUIT, STOP, START, SAVE, CLEAR, TOGGLE_OUTPUT_FORMAT, GRAPH, ADJUST_AXIS, ENTER = range(10)
+_, QUIT, STOP, START, SAVE, CLEAR, TOGGLE_OUTPUT_FORMAT, GRAPH, ADJUST_AXIS, ENTER, PROFILE = range(11)
 
 
 class RunningAverager(object):
@@ -49,28 +51,108 @@ class ScrolledText(object):
         '''
         self.size = size
         self.deque = deque([], self.size)
+        self.updates = 0
         self.clear()
 
     def append(self, s):
-        ''' Append a string 
+        ''' Append a string. The buffer is marked dirty, but not rendered.
 
         Params:
         -------
         s: string
-
-        Returns:
-        A string with new line characters
         '''
         self.deque.append(s)
-        return "\n".join(self.deque)
+        self.updates+=1
 
     def clear(self):
         '''
-        Clears the buffer and returns an empty one.
+        Clears the buffer and marks it dirty.
         '''
         for i in range(self.size):
             self.deque.append("")
-        return "\n".join(self.deque)
+        self.updates+=1
+
+    @property
+    def dirty(self):
+        ''' True if the buffer has changed since it was last rendered. '''
+        return self.updates>0
+
+    def render(self):
+        ''' Render the buffer
+
+        Returns:
+        --------
+        A string with new line characters and the number of updates that
+        were coalesced into this render.
+        '''
+        coalesced = max(self.updates-1, 0)
+        self.updates = 0
+        return "\n".join(self.deque), coalesced
+
+
+def format_values(values):
+    ''' Formats averaged values for the Results field. '''
+    return " ".join(["{:10.5f}".format(i) for i in values])
+
+
+Parsed = namedtuple('Parsed', 'sample values dump_started dump'.split())
+
+
+class LineParser(object):
+    ''' Parser of the lines read from the CTD. Data lines are averaged, and
+        the lines of a calibration parameter dump (command dc) are collected.
+    '''
+    def __init__(self, ra):
+        ''' Constructor
+
+        Params:
+        -------
+        ra: dictionary of running averagers (see UI.create_running_averagers)
+        '''
+        self.ra = ra
+        self.issaving = False
+        self.temp_list = []
+
+    def reset(self):
+        ''' Resets the running averagers. '''
+        for _, ra in self.ra.items():
+            ra.reset()
+
+    def parse(self, s):
+        ''' Parses a line
+
+        Params:
+        -------
+        s: line read from the CTD
+
+        Returns:
+        --------
+        Parsed tuple of
+        sample: (c, t, d, dt, P, T) if s is a data line (dt is None for
+                converted output), else None
+        values: the running averages, if s is a data line, else None
+        dump_started: True if s starts a calibration parameter dump
+        dump: list of lines of the dump, if s completes it, else None
+        '''
+        values = dump = None
+        dump_started = False
+        sample = ctd.parse_sample(s)
+        if sample:
+            values = [self.ra[x].append(y) for x, y in zip('c t d dt P T'.split(), sample)
+                      if not y is None]
+
+        # see if user requested to print calibration data.
+        if "SBE Slocum Payload CTD" in s:
+            self.issaving = True
+            dump_started = True
+
+        if self.issaving:
+            self.temp_list.append(s)
+            if 'POFFSET' in s:
+                dump = self.temp_list
+                self.temp_list = []
+                self.issaving = False
+        return Parsed(sample, values, dump_started, dump)
 
 
 class UI(object):
@@ -85,21 +167,38 @@ class UI(object):
                ('button','white', 'dark blue')]
     # define the sizes of each window.
     sizes = dict(top=5, body=13, bottom=2)
+    # rows of the Results field if the graph is shown in the terminal
+    body_with_graph = 5
 
-    def __init__(self, loop, queue):
+    def __init__(self, loop, queue, refresh_rate=15):
         self.loop = loop
         self.queue = queue
+        self.refresh_rate = refresh_rate
+        self.coalesced = 0
         self.islogging = False
         self.israwoutput = False
-        self.issaving = False
         self.ra = self.create_running_averagers()
+        self.parser = LineParser(self.ra)
+        self.worker = None
+        self.profiler = profiling.Profiler('main')
+        self.server = None
+        self.reference = None
+        self.archive = None
+        self.snapshot = None
+        self.graph = None
+        # the last calibration parameter dump
+        self.dump = None
         
     def create_widgets(self):
         text_top = urwid.Text(('top', u"\n"*(self.sizes['top']-1)))
         text_top_window = urwid.LineBox(text_top, title = u'Monitor')
         
-        text_body = urwid.Text(('body', u'\n'*(self.sizes['body']-1)))
-        text_body_window = urwid.LineBox(text_body, title = u'Results')
+        n_body = self.sizes['body']
+        if self.graph and self.graph.widget:
+            n_body = self.body_with_graph
+        text_body = urwid.Text(('body', u'\n'*(n_body-1)))
+        # the title of the Results field shows the status (see status_text)
+        text_body_window = urwid.LineBox(text_body, title = u'Results', title_align='left')
 
         s = [('bottom', u' '),
              ('button', u'A'), ('bottom', u': Adjust axes     '),
@@ -110,10 +209,11 @@ class UI(object):
              ('button', u'P'), ('bottom', u': Save cal params '),
              ('button', u'G'), ('bottom', u': Clear graph     '),
              ('button', u'O'), ('bottom', u': Toggle output   '),
-             ('button', u'Q'), ('bottom', u': Quit            ')]
+             ('button', u'Q'), ('bottom', u': Quit '),
+             ('button', u'F'), ('bottom', u': Profiling')]
 
         text_bottom = urwid.Text(s)
-        
+
         #text_bottom = urwid.Text(('bottom', u'S: Stop logging    R: Start logging   C: Clear averagers\nP: Save calibration params G: Toggle graph'))
         text_bottom_map = urwid.AttrMap(text_bottom, 'streak')
         text_bottom_padded = urwid.Padding(text_bottom_map, align='left', left=1, right=1)
@@ -121,8 +221,10 @@ class UI(object):
         widgets = dict(monitor = text_top_window,
                        results = text_body_window,
                        menu = text_bottom_padded)
+        if self.graph and self.graph.widget:
+            widgets['graph'] = self.graph.widget
         scrolled_texts = dict(monitor = ScrolledText(self.sizes['top']),
-                              results = ScrolledText(self.sizes['body']))
+                              results = ScrolledText(n_body))
         return widgets, scrolled_texts
 
     def key_handler(self, key):
@@ -143,6 +245,8 @@ class UI(object):
             action = ADJUST_AXIS
         elif key in ('O', 'o'):
             action = TOGGLE_OUTPUT_FORMAT
+        elif key in ('F', 'f'):
+            action = PROFILE
         elif key == ' ':
             action = ENTER
         else:
@@ -151,9 +255,13 @@ class UI(object):
             self.loop.call_soon(self.command, action)
         
     def build_top(self, widgets):
-        top = urwid.Pile([ ('pack', widgets['monitor']),
-                           ('pack', widgets['results']),
-                           ('pack', widgets['menu'])])
+        items = [('pack', widgets['monitor']),
+                 ('pack', widgets['results'])]
+        if 'graph' in widgets:
+            # the graph gets the rows left
+            items.append(('weight', 1, widgets['graph']))
+        items.append(('pack', widgets['menu']))
+        top = urwid.Pile(items)
         return top
 
     def build_app(self):
@@ -163,66 +271,134 @@ class UI(object):
         urwid_loop = urwid.MainLoop(top, self.palette, event_loop=evl, unhandled_input = self.key_handler, handle_mouse = False)
         self.widgets = widgets
         self.scrolled_texts = scrolled_texts
+        urwid_loop.set_alarm_in(1/self.refresh_rate, self.redraw)
         return urwid_loop
 
+    def redraw(self, urwid_loop, user_data=None):
+        ''' Frame timer callback. Renders the panes that were marked dirty
+            since the previous frame, and rearms the timer. Any number of
+            lines received within one frame result in one set_text call.
+        '''
+        for k, scrolled_text in self.scrolled_texts.items():
+            if scrolled_text.dirty:
+                m, coalesced = scrolled_text.render()
+                self.widgets[k].original_widget.set_text(m)
+                self.coalesced+=coalesced
+        self.show_status(urwid_loop)
+        if self.graph:
+            self.graph.render()
+        urwid_loop.set_alarm_in(1/self.refresh_rate, self.redraw)
+
+    def status_text(self):
+        ''' Returns the status, shown in the title of the Results field. '''
+        s = f"Results  coalesced: {self.coalesced}"
+        s += f"  dropped ({self.queue.policy}): {self.queue.dropped[self.queue.policy]}"
+        if self.server:
+            s += f"  subscribers: {len(self.server.subscribers)} ({self.server.dropped} dropped)"
+        if self.reference:
+            s += f"  reference points: {self.reference.n_points}"
+        if self.graph and self.graph.status():
+            s += f"  {self.graph.status()}"
+        if self.profiler.is_running:
+            s += "  PROFILING"
+        return s
+
+    def show_status(self, urwid_loop):
+        ''' Shows the status in the title of the Results field, cut to the
+            width of the screen, as a title that does not fit is wrapped
+            onto an extra row.
+        '''
+        cols = 80
+        if hasattr(urwid_loop, 'screen'):
+            cols = urwid_loop.screen.get_cols_rows()[0]
+        self.widgets['results'].set_title(self.status_text()[:max(cols - 6, 7)])
+
     async def parse_input(self):
         ''' Input parser. A asyncio coroutine, that waits for data to arrive
             on the queue, and processes them accordingly.
         '''
-        temp_list = []
         while True:
             try:
                 s = await self.queue.get()
-            except asyncio.CancelledErrror:
+            except asyncio.CancelledError:
                 break
-            m = self.scrolled_texts['monitor'].append(s.rstrip())
-            self.widgets['monitor'].original_widget.set_text(m)
-            # see if we get a d,t,c,T,P,H sextet:
-            try:
-                data_in = [float(x) for x in s.strip().split(",")]
-            except ValueError:
-                pass
-            else:
-                if len(data_in) == 6:
-                    self.israwoutput = False
-                    d, t, c, T, P, H = data_in
-                    dt = None
-                elif len(data_in) == 7:
-                    d, t, c, dt, T, P, H = data_in
-                    self.israwoutput = True
-                else:
-                    continue
-                self.islogging = True
-                if self.israwoutput:
-                    values = [self.ra[x].append(y) for x,y in zip('c t d dt P T'.split(),
-                                                                  (c,t,d, dt,P,T))]
-                else:
-                    values = [self.ra[x].append(y) for x,y in zip('c t d P T'.split(),
-                                                                  (c,t,d,P,T))]
-                svalues = ["{:10.5f}".format(i) for i in values]
-                m = self.scrolled_texts['results'].append(" ".join(svalues))
-                self.widgets['results'].original_widget.set_text(m)
-                self.graph.plot(*values)
-                self.graph.plot_points(c, t, d, dt, P, T)
-
-            # see if user requested to print calibration data.
-            if "SBE Slocum Payload CTD" in s:
-                self.issaving=True
-                self.scrolled_texts['results'].clear()
-
-            if self.issaving:
-                temp_list.append(s)
-                if 'POFFSET' in s:
-                    self.save_parameters_to_file(temp_list)
-                    self.issaving=False
-                    if len(temp_list)%2:
-                        temp_list.append("")
-                    for v in zip(temp_list[::2], temp_list[1::2]):
-                        m = self.scrolled_texts['results'].append("%35s %35s"%(v))
-                    self.widgets['results'].original_widget.set_text(m)
-                    temp_list.clear()
-                    
+            self.process_line(s)
 
+    def process_line(self, s):
+        ''' Processes a line read from the CTD. '''
+        self.scrolled_texts['monitor'].append(s.rstrip())
+        parsed = self.parser.parse(s)
+        if parsed.sample:
+            self.islogging = True
+            self.israwoutput = not parsed.sample[3] is None
+            self.scrolled_texts['results'].append(format_values(parsed.values))
+            self.graph.plot(*parsed.values)
+            self.graph.plot_points(*parsed.sample)
+            self.publish(parsed.sample)
+        if parsed.dump_started:
+            self.scrolled_texts['results'].clear()
+        if parsed.dump:
+            self.show_parameters(parsed.dump)
+
+    def apply_batch(self, batch):
+        ''' Shows a batch of lines processed by a pipeline.ParserWorker
+            (pipeline mode). Called once per batch on the event loop.
+        '''
+        for s in batch.lines:
+            self.scrolled_texts['monitor'].append(s.rstrip())
+        if batch.dump_started:
+            self.scrolled_texts['results'].clear()
+        for s in batch.results:
+            self.scrolled_texts['results'].append(s)
+        # lines that did not fit in the panes were never shown.
+        self.coalesced += batch.n_lines - len(batch.lines)
+        self.coalesced += batch.n_results - len(batch.results)
+        for dump in batch.dumps:
+            self.show_parameters(dump)
+        for values in batch.values:
+            self.graph.plot(*values)
+        for sample in batch.points:
+            self.graph.plot_points(*sample)
+        for sample in batch.samples:
+            self.publish(sample)
+        if len(batch.received):
+            if self.archive:
+                self.archive.extend(batch.received)
+            if self.reference:
+                self.reference.add_rows(batch.received)
+        if batch.n_results:
+            self.islogging = True
+            self.israwoutput = batch.israwoutput
+        # the averagers are run by the worker; their state is kept here for
+        # the snapshots.
+        for k, (n, xp) in batch.averagers.items():
+            self.ra[k].k = n
+            self.ra[k].xp = xp
+
+    def publish(self, sample):
+        ''' Passes a sample to the broadcast server. The archive and the
+            reference recorder receive the samples as they arrive, before
+            the overload policy (see ctd.CTDInterface.consume() and
+            pipeline.Worker).
+        '''
+        if self.server:
+            self.server.publish(*sample)
+
+    def show_parameters(self, dump):
+        ''' Saves the calibration parameters dumped by the CTD and shows
+            them in the Results field.
+        '''
+        self.save_parameters_to_file(dump)
+        self.dump = list(dump)
+        self.show_dump(dump)
+
+    def show_dump(self, dump):
+        ''' Shows the lines of a calibration parameter dump in pairs. '''
+        dump = list(dump)
+        if len(dump)%2:
+            dump.append("")
+        for v in zip(dump[::2], dump[1::2]):
+            self.scrolled_texts['results'].append("%35s %35s"%(v))
 
     def create_running_averagers(self):
         ''' create running averagers for c t and d variables.'''
@@ -236,13 +412,16 @@ class UI(object):
         
     def command(self, action):
         if action == QUIT:
+            if self.profiler.is_running:
+                self.toggle_profiling()
             self.graph.close()
             raise asyncio.CancelledError()
         elif action == CLEAR:
-            for _, ra in self.ra.items():
-                ra.reset()
-            m = self.scrolled_texts['results'].clear()
-            self.widgets['results'].original_widget.set_text(m)
+            if self.worker:
+                self.worker.reset()
+            else:
+                self.parser.reset()
+            self.scrolled_texts['results'].clear()
         elif action == SAVE:
             if not self.islogging:
                 self.write_command('dc')
@@ -265,6 +444,23 @@ class UI(object):
             self.graph.adjust_axes()
         elif action == ENTER:
             self.write_command('')
+        elif action == PROFILE:
+            self.toggle_profiling()
+
+    def toggle_profiling(self):
+        ''' Starts or stops profiling of this process, the worker process
+            (pipeline mode) and the plot process. The state of this
+            process is set in the others, so that they cannot get out of
+            step.
+        '''
+        on = not self.profiler.is_running
+        if on:
+            self.profiler.start()
+        else:
+            self.profiler.stop()
+        if self.worker:
+            self.worker.set_profiling(on)
+        self.graph.set_profiling(on)
             
     def save_parameters_to_file(self, s):
         ''' Save calibration parameters to file with date time indication.'''
@@ -272,5 +468,7 @@ class UI(object):
         with open(fn, 'w') as fp:
             for l in s:
                 fp.write("{}\n".format(l))
+        if self.archive:
+            self.archive.add_configuration(fn)
 
     